@@ -9,6 +9,7 @@ from configparser import ConfigParser
 from youtube.tools import *
 from youtube.chat import LiveChat
 from youtube.target import Session
+from youtube.sink import open_session_sink
 
 # Read the config file
 config = ConfigParser()
@@ -32,8 +33,9 @@ if __name__ == '__main__':
     if livebroadcast.livechat_id is None:
         exit(">>> The livechat attached to this livebroadcast is no longer active.")
 
-    # Create the Chat object where the messages will be stored
-    session = Session()
+    # Create the Chat object where the messages will be stored (and streamed
+    # to a file while the chat runs)
+    session = Session(sink=open_session_sink(livebroadcast.title))
 
     # Create the LiveChat object associated to the live broadcast
     livechat = LiveChat(client, livebroadcast.livechat_id, session)
@@ -41,6 +43,11 @@ if __name__ == '__main__':
 
     livechat.start_refresh_loop()
 
+    # Complete the file to which the session was streamed
+    session.close()
+    if session.sink is not None:
+        session.save()
+
     # At this points, the live chat is over...
     tkinter.Tk().withdraw()
     file_name = tkinter.filedialog.asksaveasfilename(
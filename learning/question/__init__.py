@@ -1 +1,2 @@
-from .rnn.rnn_question import rnn_predict
\ No newline at end of file
+from .models import registry, predictors, predictor_inputs, rnn_predict, rnn_predict_sentences, material_predict
+from .rnn.preprocessing import prepare
\ No newline at end of file
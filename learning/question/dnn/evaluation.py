@@ -0,0 +1,104 @@
+""" evaluation module defines functions to evaluate a binary classifier from
+its predictions. The model predicts once, and the confusion matrices for all
+the thresholds are computed at once (sorting the predictions and taking
+cumulative sums), instead of predicting again for each threshold.
+
+A prediction p is classified as positive at threshold t if p >= t.
+
+The functions are:
+
+    confusion_curves        Confusion matrices for many thresholds
+    metric_curves           Precision, recall and F1 for many thresholds
+    best_threshold          The threshold maximizing the F1 score
+    classification_table    Table (string) of a confusion matrix
+    evaluate                Predict once and return the metric curves
+"""
+
+import numpy as np
+
+
+def confusion_curves(y, predictions, thresholds=None):
+    """ Given the true labels y (0 or 1) and the predictions (floats), return
+    the thresholds and the number of true positives, false positives, false
+    negatives and true negatives at each of them (arrays).
+
+    By default, the thresholds are the distinct predictions, which gives
+    every distinct confusion matrix.
+    """
+
+    y = np.asarray(y).ravel().astype(bool)
+    predictions = np.asarray(predictions, dtype=np.float64).ravel()
+    if thresholds is None:
+        thresholds = np.unique(predictions)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    order = np.argsort(predictions, kind='mergesort')
+    sorted_predictions = predictions[order]
+    # positives_below[i] is the nbr of positives among the i smallest predictions
+    positives_below = np.concatenate(([0], np.cumsum(y[order])))
+
+    # The predictions at index >= below are classified as positive
+    below = np.searchsorted(sorted_predictions, thresholds, side='left')
+    n, positives = len(y), int(positives_below[-1])
+
+    true_pos = positives - positives_below[below]
+    false_pos = (n - below) - true_pos
+    false_neg = positives - true_pos
+    true_neg = (n - positives) - false_pos
+    return thresholds, true_pos, false_pos, false_neg, true_neg
+
+def _ratio(numerator, denominator):
+    """ numerator/denominator, nan where the denominator is 0. """
+
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+
+def metric_curves(y, predictions, thresholds=None):
+    """ Return a dict of arrays with the thresholds (see confusion_curves),
+    the confusion matrices ('true_pos', 'false_pos', 'false_neg' and
+    'true_neg') and the 'precision', 'recall' and 'f1' at each threshold (nan
+    when undefined).
+    """
+
+    thresholds, tp, fp, fn, tn = confusion_curves(y, predictions, thresholds)
+    return {
+        'thresholds': thresholds,
+        'true_pos': tp,
+        'false_pos': fp,
+        'false_neg': fn,
+        'true_neg': tn,
+        'precision': _ratio(tp, tp + fp),
+        'recall': _ratio(tp, tp + fn),
+        'f1': _ratio(2*tp, 2*tp + fp + fn),
+    }
+
+def best_threshold(curves):
+    """ Given metric curves, return the threshold with the best F1 score and
+    this score.
+    """
+
+    f1 = curves['f1']
+    if len(f1) == 0 or np.all(np.isnan(f1)):
+        return None, np.nan
+    best = int(np.nanargmax(f1))
+    return float(curves['thresholds'][best]), float(f1[best])
+
+def classification_table(true_pos, false_pos, false_neg, true_neg):
+    """ Return a table (string) of the confusion matrix. """
+
+    table = """
+                          Truth
+                   |   Pos  |   Neg  |
+    ----------------------------------
+    Class  |  Pos  |  {:3}  |   {:3} |
+           |  Neg  |  {:3}  |   {:3} |
+    ----------------------------------
+    """.format(int(true_pos), int(false_pos), int(false_neg), int(true_neg))
+
+    return table
+
+def evaluate(model, x, y, thresholds=None):
+    """ Predict the featurized examples x once and return the metric curves
+    against the true labels y (see metric_curves).
+    """
+
+    return metric_curves(y, model.predict(x), thresholds)
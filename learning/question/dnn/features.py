@@ -0,0 +1,177 @@
+""" features module defines the TfidfFeaturizer, which turns chat messages
+into the tf-idf features of the material question model. The features are
+those of the keras Tokenizer (texts_to_matrix with mode 'tfidf'), but in a
+scipy.sparse CSR matrix, so a batch of messages takes memory in proportion
+to its number of words instead of the size of the vocabulary. This module
+doesn't depend on tensorflow.
+
+The classes are:
+
+    TfidfFeaturizer         Sparse tf-idf features of messages
+
+The functions are:
+
+    remove_floats           Replace the numbers of a message by '#'
+    tokenize                Split a message into words (as keras does)
+"""
+
+import re
+import json
+from collections import Counter
+
+import numpy as np
+import scipy.sparse as sp
+
+# The characters removed by the keras Tokenizer
+FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+_FILTER_TABLE = str.maketrans(FILTERS, ' '*len(FILTERS))
+_NUMBERS = re.compile(r'\d+')
+
+def remove_floats(text):
+    try:
+        new_text = _NUMBERS.sub(r'#', text)
+    except TypeError as e:
+        new_text = ""
+    return new_text
+
+def tokenize(text):
+    """ Return the words of text, as split by the keras Tokenizer (after the
+    numbers are replaced by '#', which is then filtered out).
+    """
+
+    return remove_floats(text).lower().translate(_FILTER_TABLE).split()
+
+
+class TfidfFeaturizer:
+    """ A TfidfFeaturizer computes the tf-idf features of texts. It is fitted
+    on a corpus (an iterable of texts, which may be a generator), then
+    transforms batches of texts into CSR matrices of shape
+    (len(texts), num_words), as the keras Tokenizer does: column i is the
+    word of rank i in the corpus (column 0 is never used) and the words
+    outside the num_words - 1 most frequent are ignored.
+
+    Attributes:
+        num_words: The nbr of columns of the features. If None, every word of
+            the corpus has a column.
+        word_index: The column of each word of the vocabulary.
+
+    Methods:
+        fit: Fit the vocabulary and document frequencies on a corpus.
+        transform: Return the features of a batch of texts.
+        iter_transform: Yield the features of a stream of texts, by batches.
+        save: Save the fitted featurizer to a json file.
+        load: Load a featurizer saved to a json file (class method).
+    """
+
+    def __init__(self, num_words=20000):
+        self.num_words = num_words
+        self.word_index = {}
+        self.document_count = 0
+        self._idf = np.zeros(1, dtype=np.float32)
+
+    def fit(self, texts):
+        """ Fit the vocabulary on the texts and return the featurizer. """
+
+        word_counts = Counter()
+        word_docs = Counter()
+        document_count = 0
+        for text in texts:
+            words = tokenize(text)
+            document_count += 1
+            word_counts.update(words)
+            word_docs.update(set(words))
+
+        # Rank the words by frequency (the first seen first among equals)
+        ranked = sorted(word_counts, key=word_counts.get, reverse=True)
+        if self.num_words is not None:
+            ranked = ranked[:self.num_words - 1]
+        self.word_index = {word: i + 1 for i, word in enumerate(ranked)}
+        self.document_count = document_count
+        self._set_idf({word: word_docs[word] for word in ranked})
+        return self
+
+    def _set_idf(self, docs):
+        """ Compute the idf of each column from the nbr of docs of each word. """
+
+        self._idf = np.zeros(self.size, dtype=np.float32)
+        for word, i in self.word_index.items():
+            self._idf[i] = np.log(1 + self.document_count / (1 + docs[word]))
+
+    @property
+    def size(self):
+        """ The nbr of columns of the features. """
+
+        if self.num_words is not None:
+            return self.num_words
+        return len(self.word_index) + 1
+
+    def transform(self, texts):
+        """ Return the features of the texts (a list of strings), a float32
+        CSR matrix of shape (len(texts), size).
+        """
+
+        indptr = [0]
+        indices, counts = [], []
+        for text in texts:
+            row = Counter(
+                i for i in map(self.word_index.get, tokenize(text)) if i is not None
+            )
+            indices.extend(row.keys())
+            counts.extend(row.values())
+            indptr.append(len(indices))
+
+        indices = np.array(indices, dtype=np.int32)
+        tf = 1 + np.log(np.array(counts, dtype=np.float32))
+        features = sp.csr_matrix(
+            (tf*self._idf[indices], indices, np.array(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, self.size),
+            dtype=np.float32
+        )
+        features.sort_indices()
+        return features
+
+    def fit_transform(self, texts):
+        texts = list(texts)
+        return self.fit(texts).transform(texts)
+
+    def iter_transform(self, texts, batch_size=1024):
+        """ Yield the features of the texts (any iterable of strings) by
+        batches of batch_size texts.
+        """
+
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == batch_size:
+                yield self.transform(batch)
+                batch = []
+        if len(batch) > 0:
+            yield self.transform(batch)
+
+    def save(self, file_name):
+        """ Save the vocabulary and the idf of the featurizer to file_name. """
+
+        with open(file_name, 'w', encoding='utf8') as f:
+            json.dump({
+                'num_words': self.num_words,
+                'document_count': self.document_count,
+                'word_index': self.word_index,
+                'idf': self._idf.tolist(),
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Return the featurizer saved in file_name. """
+
+        with open(file_name, 'r', encoding='utf8') as f:
+            saved = json.load(f)
+        featurizer = cls(saved['num_words'])
+        featurizer.document_count = saved['document_count']
+        featurizer.word_index = saved['word_index']
+        featurizer._idf = np.array(saved['idf'], dtype=np.float32)
+        return featurizer
+
+    def __repr__(self):
+        return "Tf-idf featurizer ({} words, {} documents).".format(
+            len(self.word_index), self.document_count
+        )
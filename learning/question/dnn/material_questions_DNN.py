@@ -1,21 +1,32 @@
+import os
 import numpy as np
 import pandas as pd
-import re
-import json
-import operator
+from math import ceil
 
-from tensorflow.python.keras.preprocessing.text import Tokenizer
-
-from tensorflow.python.keras.models import Sequential
+from tensorflow.python.keras.utils import Sequence
+from tensorflow.python.keras.models import Sequential, load_model
 from tensorflow.python.keras.layers import Dense
 
+try:
+    from .evaluation import confusion_curves, metric_curves, best_threshold, classification_table
+    from .features import TfidfFeaturizer, remove_floats
+except ImportError: # Run as a script
+    from evaluation import confusion_curves, metric_curves, best_threshold, classification_table
+    from features import TfidfFeaturizer, remove_floats
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 DATA_DIR = "..\\..\\drive-archive\\datasets\\material_questions\\full.csv"
 DATA_COLUMN_NAMES = ['content', 'is_material_q']
 
+# Where the trained model and its vocabulary are saved
+MODEL_FILE = os.path.join(BASE_DIR, 'trained', 'material.hdf5')
+VOCABULARY_FILE = os.path.join(BASE_DIR, 'trained', 'material-vocabulary.json')
+
 TEST_TRAIN_SPLIT = 0.5
 
 # Some hyperparameters
-num_words = None
+num_words = 20000
 treshold = 1./25
 
 def load_full_data():
@@ -32,36 +43,56 @@ def load_data(test_train_split=TEST_TRAIN_SPLIT):
     test_x, test_y = test, test.pop(DATA_COLUMN_NAMES[-1])
     return (train_x, train_y), (test_x, test_y)
 
-def remove_floats(text):
-    nbrs = re.compile(r'\d+')
-    try:
-        new_text = nbrs.sub(r'#', text)
-    except TypeError as e:
-        new_text = ""
-    return new_text
+class SparseBatches(Sequence):
+    """ A SparseBatches object generates the batches of a sparse feature
+    matrix (and its labels), which are only made dense one batch at a time.
+    """
+
+    def __init__(self, x, y=None, batch_size=32):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+
+    def __getitem__(self, idx):
+        batch = slice(idx*self.batch_size, (idx + 1)*self.batch_size)
+        x = self.x[batch].toarray()
+        if self.y is None:
+            return x
+        return x, self.y[batch]
+
+    def __len__(self):
+        return ceil(self.x.shape[0]/self.batch_size)
+
+def predict(model, features, batch_size=1024):
+    """ Return the predictions (floats) of the model on sparse features. """
+
+    if features.shape[0] == 0:
+        return np.zeros(0, dtype=np.float32)
+    return model.predict_generator(SparseBatches(features, batch_size=batch_size))[:, 0]
 
-def is_material_q(model, texts, treshold=treshold):
-    features = tokenizer.texts_to_matrix(map(remove_floats, texts))
-    prediction = model.predict(np.array(features))[0][0]
-    return prediction >= treshold
+def load_material_model(model_file=MODEL_FILE, vocabulary_file=VOCABULARY_FILE):
+    """ Return the trained model and its featurizer. """
+
+    return load_model(model_file), TfidfFeaturizer.load(vocabulary_file)
+
+def material_predict(model, featurizer, texts):
+    """ Return the probability that each of the texts is a material question. """
+
+    return predict(model, featurizer.transform(texts))
+
+def is_material_q(model, featurizer, texts, treshold=treshold):
+    return material_predict(model, featurizer, texts) >= treshold
+
+def _confusion(model, x, y, treshold):
+    """ Return the confusion matrix (true_pos, false_pos, false_neg, true_neg)
+    of the model on the featurized examples x at treshold.
+    """
+
+    _, tp, fp, fn, tn = confusion_curves(y, predict(model, x), [treshold])
+    return tp[0], fp[0], fn[0], tn[0]
 
 def F1_score(model, x, y, treshold=treshold):
-    predictions = model.predict(x) # floats
-    predictions = np.array([1 if x >= treshold else 0 for x in predictions]) # binary
-
-    true_pos, false_pos, false_neg, true_neg = 0, 0, 0, 0
-    for i in range(y.shape[0]):
-        if y[i] == 1:
-            if predictions[i] == 1:
-                true_pos += 1
-            else:
-                false_neg += 1
-        else:
-            if predictions[i] == 1:
-                false_pos += 1
-            else:
-                true_neg += 1
-                
+    true_pos, false_pos, false_neg, true_neg = _confusion(model, x, y, treshold)
     return 2*true_pos/(2*true_pos + false_pos + false_neg)
     
 def classification(model, x, y, treshold=treshold):
@@ -69,32 +100,7 @@ def classification(model, x, y, treshold=treshold):
     and the true labels, returns a table (string) of the results.
     """
 
-    predictions = model.predict(x) # floats
-    predictions = np.array([1 if x >= treshold else 0 for x in predictions]) # binary
-
-    true_pos, false_pos, false_neg, true_neg = 0, 0, 0, 0
-    for i in range(y.shape[0]):
-        if y[i] == 1:
-            if predictions[i] == 1:
-                true_pos += 1
-            else:
-                false_neg += 1
-        else:
-            if predictions[i] == 1:
-                false_pos += 1
-            else:
-                true_neg += 1
-
-    table = """
-                          Truth
-                   |   Pos  |   Neg  |
-    ----------------------------------
-    Class  |  Pos  |  {:3}  |   {:3} |
-           |  Neg  |  {:3}  |   {:3} |
-    ----------------------------------
-    """.format(true_pos, false_pos, false_neg, true_neg)
-
-    return table
+    return classification_table(*_confusion(model, x, y, treshold))
 
 
 def precision(model, x, y, treshold=treshold):
@@ -102,19 +108,7 @@ def precision(model, x, y, treshold=treshold):
     and the true labels, returns the precision of the model.
     """
 
-    predictions = model.predict(x) # floats
-    predictions = np.array([1 if x >= treshold else 0 for x in predictions]) # binary    
-    true_pos = sum(y)
-
-    true_pos, false_pos = 0, 0
-    for i in range(y.shape[0]):
-        if y[i] == 1:
-            if predictions[i] == 1:
-                true_pos += 1
-        else:
-            if predictions[i] == 1:
-                false_pos += 1
-    
+    true_pos, false_pos, _, _ = _confusion(model, x, y, treshold)
     if true_pos + false_pos == 0:
         return np.nan
     else:
@@ -125,17 +119,7 @@ def recall(model, x, y, treshold=treshold):
     and the true labels, returns the recall of the model.
     """
 
-    predictions = model.predict(x) # floats
-    predictions = np.array([1 if x >= treshold else 0 for x in predictions]) # binary
-
-    true_pos, false_neg= 0, 0
-    for i in range(y.shape[0]):
-        if y[i] == 1:
-            if predictions[i] == 1:
-                true_pos += 1
-            else:
-                false_neg += 1
-                
+    true_pos, _, false_neg, _ = _confusion(model, x, y, treshold)
     if true_pos + false_neg == 0:
         return np.nan
     else:
@@ -143,73 +127,74 @@ def recall(model, x, y, treshold=treshold):
 
 
 
-# Load all data
-full_data = load_full_data()
-full_data['content'] = full_data['content'].map(remove_floats)
-
-# Preprocess data by extracting features
-tokenizer = Tokenizer(num_words=num_words)
-tokenizer.fit_on_texts(full_data['content'].tolist())
+if __name__ == "__main__":
+    # Load all data
+    full_data = load_full_data()
+    full_data['content'] = full_data['content'].map(remove_floats)
 
-# for word in list(tokenizer.word_index.keys())[10:50]:
-    # print("{}: {}".format(word, tokenizer.word_counts[word]))
+    # Preprocess data by extracting features
+    featurizer = TfidfFeaturizer(num_words=num_words)
 
-# The design matrix, which has shape (samples, num_words)
-features = tokenizer.texts_to_matrix(full_data['content'], mode='tfidf')
+    # The design matrix (sparse), which has shape (samples, num_words)
+    features = featurizer.fit_transform(full_data['content'].tolist())
 
-# Split the data into training and test sets
-split = round(TEST_TRAIN_SPLIT*full_data.shape[0])
-train_x = features[:split]
-test_x  = features[split:]
-train_y = np.array(full_data[DATA_COLUMN_NAMES[-1]][:split])
-test_y  = np.array(full_data[DATA_COLUMN_NAMES[-1]][split:])
+    # Split the data into training and test sets
+    split = round(TEST_TRAIN_SPLIT*full_data.shape[0])
+    train_x = features[:split]
+    test_x  = features[split:]
+    train_y = np.array(full_data[DATA_COLUMN_NAMES[-1]][:split])
+    test_y  = np.array(full_data[DATA_COLUMN_NAMES[-1]][split:])
 
-print("""Shapes:
+    print("""Shapes:
 train_x: {}
 train_y: {}
 test_x : {}
 test_y : {}
 """.format(train_x.shape[1], train_x.shape, train_y.shape, test_x.shape, test_y.shape, ))
 
-# Build the model
-model = Sequential()
-#model.add(Dense(32, activation='relu', input_dim=num_words))
-#model.add(Dense(1, activation='sigmoid'))
-model.add(Dense(1, activation='sigmoid', input_dim=train_x.shape[1]))
-model.compile(optimizer='adagrad',
-              loss='binary_crossentropy',
-              metrics=['accuracy'])
-
-# Train the model
-training = model.fit(
-    train_x,
-    train_y,
-    epochs=20,
-    batch_size=32,
-    validation_split=0.2
-)
-
-# Compute the model's score
-score = model.evaluate(test_x, test_y)
-print("Metrics: {}".format(model.metrics_names))
-print("Score: {}".format(score))
-print(classification(model, test_x, test_y))
-
-print("(Precision, Recall, F1) = ({}, {}, {})".format(
-    precision(model, test_x, test_y),
-    recall(model, test_x, test_y),
-    F1_score(model, test_x, test_y)
-))
-
-F1scores = list(enumerate([
-    F1_score(model, test_x, test_y, d/100.) for d in range(0, 100)
-]))
-F1scores.sort(key=operator.itemgetter(1))
-
-print(F1scores[-1])
-
-# Use the model
-# while True:
-    # message = input(">>> Input a message: ")
-    # prediction = is_material_q(model, [message])
-    # print("Prediction on \"{}\": {}".format(message, prediction))
+    # Build the model
+    model = Sequential()
+    #model.add(Dense(32, activation='relu', input_dim=num_words))
+    #model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', input_dim=train_x.shape[1]))
+    model.compile(optimizer='adagrad',
+                  loss='binary_crossentropy',
+                  metrics=['accuracy'])
+
+    # Train the model (the last 20% of the training set is used for validation)
+    validation = round(0.8*train_x.shape[0])
+    training = model.fit_generator(
+        SparseBatches(train_x[:validation], train_y[:validation], batch_size=32),
+        epochs=20,
+        validation_data=SparseBatches(train_x[validation:], train_y[validation:], batch_size=32)
+    )
+
+    os.makedirs(os.path.dirname(MODEL_FILE), exist_ok=True)
+    model.save(MODEL_FILE)
+    featurizer.save(VOCABULARY_FILE)
+
+    # Compute the model's score
+    score = model.evaluate_generator(SparseBatches(test_x, test_y))
+    print("Metrics: {}".format(model.metrics_names))
+    print("Score: {}".format(score))
+
+    # Predict the test set once and evaluate every treshold on these predictions
+    predictions = predict(model, test_x)
+    curves = metric_curves(test_y, predictions)
+    at_treshold = metric_curves(test_y, predictions, [treshold])
+    print(classification_table(*(at_treshold[k][0] for k in
+        ['true_pos', 'false_pos', 'false_neg', 'true_neg'])))
+
+    print("(Precision, Recall, F1) = ({}, {}, {})".format(
+        at_treshold['precision'][0],
+        at_treshold['recall'][0],
+        at_treshold['f1'][0]
+    ))
+
+    print("Best (treshold, F1): {}".format(best_threshold(curves)))
+
+    # Use the model
+    # while True:
+        # message = input(">>> Input a message: ")
+        # prediction = is_material_q(model, featurizer, [message])
+        # print("Prediction on \"{}\": {}".format(message, prediction))
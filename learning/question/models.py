@@ -0,0 +1,135 @@
+""" models module defines the registry of the question models. A model is
+only loaded (with tensorflow) the first time it is needed, or in the
+background when it is preloaded, so importing learning.question is cheap.
+
+The classes are:
+
+    ModelRegistry           Loads the registered models when first needed
+
+The predictors dict maps the name of a model to a function predicting the
+probabilities of a list of inputs (it is what the inference server serves),
+and predictor_inputs gives the inputs expected by each predictor:
+
+    'sentences'     Prepared sentences (see prepare), one probability each
+    'messages'      Raw texts of messages, one probability each
+
+The functions are:
+
+    rnn_predict             Predict if a message is a question (RNN)
+    rnn_predict_sentences   Predict if prepared sentences are questions (RNN)
+    material_predict        Predict if messages are material questions (DNN)
+"""
+
+import threading
+
+
+class ModelRegistry:
+    """ A ModelRegistry maps names to functions loading models. Each model is
+    loaded once, the first time it is requested (by get) or in a background
+    thread (by preload), and then kept.
+
+    Methods:
+        register: Register the function loading a model.
+        get: Return a model, loading it if needed.
+        preload: Start loading a model in a background thread.
+        is_loaded: True if a model is loaded.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        """ Register loader, a function without arguments returning the model
+        called name.
+        """
+
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+            self._models.pop(name, None)
+
+    def get(self, name):
+        """ Return the model called name. The first call loads the model
+        (other threads asking for it wait until it is loaded).
+        """
+
+        try:
+            return self._models[name]
+        except KeyError:
+            pass
+        with self._lock:
+            lock = self._locks[name]
+        with lock:
+            if name not in self._models:
+                self._models[name] = self._loaders[name]()
+            return self._models[name]
+
+    def preload(self, name):
+        """ Start loading the model called name in a (daemon) thread and return
+        the thread.
+        """
+
+        thread = threading.Thread(target=self.get, args=(name,), daemon=True)
+        thread.start()
+        return thread
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def __repr__(self):
+        return "Model registry ({}).".format(", ".join(
+            "{}{}".format(name, "" if name in self._models else " (not loaded)")
+            for name in self._loaders
+        ))
+
+
+registry = ModelRegistry()
+
+def _load_rnn():
+    from .rnn.rnn_question import load_best_model
+    return load_best_model()
+
+registry.register('rnn', _load_rnn)
+
+def rnn_predict(message):
+    """ Return the prediction of the RNN model on message. """
+
+    from .rnn.rnn_question import infer_from_model
+    return infer_from_model(registry.get('rnn'), message)
+
+def rnn_predict_sentences(sentences):
+    """ Return the probability that each of the prepared sentences is a
+    question, according to the RNN model.
+    """
+
+    from .rnn.rnn_question import predict_sentences
+    return predict_sentences(registry.get('rnn'), sentences)
+
+def _load_material():
+    from .dnn.material_questions_DNN import load_material_model
+    return load_material_model()
+
+registry.register('material', _load_material)
+
+def material_predict(texts):
+    """ Return the probability that each of the texts (the content of
+    messages) is a material question, according to the DNN model.
+    """
+
+    from .dnn import material_questions_DNN
+    model, featurizer = registry.get('material')
+    return material_questions_DNN.material_predict(model, featurizer, texts)
+
+predictors = {
+    'rnn': rnn_predict_sentences,
+    'material': material_predict,
+}
+
+predictor_inputs = {
+    'rnn': 'sentences',
+    'material': 'messages',
+}
+
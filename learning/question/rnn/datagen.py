@@ -8,19 +8,25 @@ Step 2: Append labeled data to the test and training set (mode '1')
 The output of step 1 is a csv file with sentences labeled using the
 default_label parameter of the prepare_for_labeling function. The user can
 the open the csv file and change the label manually.
+
+The script is run as a module, from the root of the repository:
+
+    python -m learning.question.rnn.datagen prepare
 """
 
-from math import ceil
 import json
 import os
 from configparser import ConfigParser
 import pandas as pd
 import tkinter
 from tkinter.filedialog import askopenfilename, asksaveasfilename
-from rnn_question import prepare
+from youtube.ressources import iter_ressources
+from .preprocessing import iter_prepare
+from .dataset import DatasetStore
 
-# Load local config file
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Load local config file
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.ini')
 config = ConfigParser()
 config.read(CONFIG_FILE)
@@ -30,22 +36,21 @@ RESSOURCES_INCLUDED = os.path.join(config['data']['datadir'], 'ressources_includ
 
 COLUMN = ['sentences', 'category']
 
-def prepare_for_labeling(ressource_file, output_file, default_label=0):
+def prepare_for_labeling(ressource_file, output_file, default_label=0, processes=None):
     """ Takes a path to a youtube#liveChatMessage ressource_file (as
     produced when a LiveChat is saved to json), prepares the content of the
     messages, labels them using default_label and saves the resulting two
-    column csv file to output_file.
+    column csv file to output_file. The messages are prepared by a pool of
+    processes if processes is more than 1.
     """
 
-    with open(ressource_file, 'r', encoding='utf8') as f:
-        ressources = json.load(f)
-
-    messages = [
+    # The messages are streamed: only the distinct sentences are kept in memory
+    messages = (
         ress['snippet']['textMessageDetails']['messageText']
-        for ress in ressources
-    ]
+        for ress in iter_ressources(ressource_file)
+    )
 
-    unlabeled = pd.Series(prepare(messages), name=COLUMN[0])
+    unlabeled = pd.Series(list(iter_prepare(messages, processes)), name=COLUMN[0])
     labels =    pd.Series([default_label]*len(unlabeled), name=COLUMN[1])
 
     pd.concat([unlabeled, labels], axis=1).to_csv(output_file, index=False)
@@ -64,62 +69,89 @@ def append_to_datasets(labeled_data):
             print(">>> Exiting without appending the dataset.")
             return
 
-    train = pd.read_csv(config['data']['trainset'])
-    test = pd.read_csv(config['data']['testset'])
-    print(">>> Before:\ntest: {}\ntrain: {}".format(test.shape, train.shape))
+    store = open_store()
+    print(">>> Before: {}".format(store))
 
     new_data = pd.read_csv(labeled_data)
     print(">>> New data: {}".format(new_data.shape))
 
-    questions = new_data.loc[new_data['category'] == 1]
-    not_questions = new_data.loc[new_data['category'] == 0]
+    # Only the new sentences are written (the train/test split of a sentence
+    # is given by its hash)
+    added = store.append(new_data[COLUMN[0]], new_data[COLUMN[1]], source=labeled_data)
+    print(">>> After: {} ({} new sentences)".format(store, added))
+    print(">>> The data has been included in the test and training sets.")
+    included.append(labeled_data)
 
-    questions_split = ceil(
-        config.getfloat('training', 'testtrainsplit')*len(questions)
-    )
-    not_questions_split = ceil(
-        config.getfloat('training', 'testtrainsplit')*len(not_questions)
-    )
+    with open(RESSOURCES_INCLUDED, 'w') as f:
+        json.dump(included, f, indent=4)
 
-    # Split the questions
-    test = test.append(questions.loc[:questions_split], ignore_index=True)
-    train = train.append(questions.loc[questions_split:], ignore_index=True)
+def open_store():
+    """ Open the store of the train and test datasets. An empty store is
+    first filled with the sentences of the train and test csv files (the
+    datasets from before the store).
+    """
 
-    # Split the non-questions
-    test = test.append(not_questions.loc[:not_questions_split], ignore_index=True)
-    train = train.append(not_questions.loc[not_questions_split:], ignore_index=True)
+    store = _dataset_store()
+    if len(store) == 0:
+        import_datasets(store)
+    return store
 
-    print(">>> After:\ntest: {}\ntrain: {}".format(test.shape, train.shape))
+def _dataset_store():
+    return DatasetStore(
+        config['data']['store'],
+        test_split=config.getfloat('training', 'testtrainsplit')
+    )
 
-    train.to_csv(config['data']['trainset'], index=False)
-    test.to_csv(config['data']['testset'], index=False)
+def import_datasets(store=None):
+    """ Add the sentences of the train and test csv files (those which
+    exist) to the store, each to the set of its file.
+    """
 
-    print(">>> The data has been included in the test and training sets.")
-    included.append(labeled_data)
+    if store is None:
+        store = _dataset_store()
+    for split in ['train', 'test']:
+        data_file = config['data'][split + 'set']
+        if not os.path.exists(data_file):
+            continue
+        data = pd.read_csv(data_file)
+        added = store.append(data[COLUMN[0]], data[COLUMN[1]], source=data_file,
+                             split=split)
+        print(">>> {} sentences imported from {}.".format(added, data_file))
+    print(">>> {}".format(store))
+
+def export_datasets(store=None):
+    """ Save the train and test sets of the store to the train and test csv
+    files (the training reads the store, the csv files are only an export).
+    Nothing is written if the store is empty, so the csv files are never
+    replaced by empty ones.
+    """
 
-    with open(RESSOURCES_INCLUDED, 'w') as f:
-        json.dump(included, f, indent=4)
+    if store is None:
+        store = open_store()
+    if len(store) == 0:
+        print(">>> The dataset store is empty: the datasets are not exported.")
+        return False
+    store.export('train', config['data']['trainset'])
+    store.export('test', config['data']['testset'])
+    return True
 
 def shuffle_datasets():
-    """ Loads the train and test datasets and shuffles them. """
-
-    train = pd.read_csv(config['data']['trainset'])
-    test = pd.read_csv(config['data']['testset'])
-
-    train = train.sample(frac=1).reset_index(drop=True)
-    test = test.sample(frac=1).reset_index(drop=True)
+    """ Shuffles the train and test datasets (only a new permutation is
+    saved, see DatasetStore.shuffle).
+    """
 
-    train.to_csv(config['data']['trainset'], index=False)
-    test.to_csv(config['data']['testset'], index=False)
+    store = open_store()
+    if len(store) == 0:
+        print(">>> The dataset store is empty: nothing to shuffle.")
+        return
+    store.shuffle()
 
 def generate_intchar(intchar_file):
-    train = pd.read_csv(config['data']['trainset'])
-    test = pd.read_csv(config['data']['testset'])
-    full = train.append(test, ignore_index=True)
-    
-    sent = full[COLUMN[0]]
-    chars = sorted(list(set(''.join(sent))))
-    corr = dict(list(enumerate(chars)))
+    store = open_store()
+    if len(store) == 0:
+        print(">>> The dataset store is empty: the int-char file is not written.")
+        return
+    corr = dict(list(enumerate(store.chars())))
     
     with open(intchar_file, 'w') as f:
         json.dump(corr, f, indent=4)
@@ -132,9 +164,14 @@ if __name__ == "__main__":
         "shuffle: Shuffle the dataset;"
         "prepare: prepare raw data (from ressource) to be labeled;\n"
         "append: Incorporate labeled examples to the train and test datasets."
-        "intchar: Generate an int-char bijection file.",
+        "intchar: Generate an int-char bijection file.\n"
+        "import: Add the examples of the train and test csv files to the store;\n"
+        "export: Save the train and test datasets of the store to csv files.",
         default="shuffle"
     )
+    parser.add_argument('--processes', type=int, default=None,
+        help="Nbr of processes preparing the messages (prepare mode)."
+    )
     args = parser.parse_args()
 
     if args.mode == "shuffle":
@@ -155,7 +192,7 @@ if __name__ == "__main__":
             initialfile=initialfile+'label_me'
         )
 
-        prepare_for_labeling(ressource_file, output_file)
+        prepare_for_labeling(ressource_file, output_file, processes=args.processes)
     elif args.mode == "append":
         tkinter.Tk().withdraw()
         labeled_data = tkinter.filedialog.askopenfilename(
@@ -175,5 +212,9 @@ if __name__ == "__main__":
         )
 
         generate_intchar(intchar_file)
+    elif args.mode == "import":
+        import_datasets()
+    elif args.mode == "export":
+        export_datasets()
     else:
         print(">>> invalid mode: {}".format(args.mode))
\ No newline at end of file
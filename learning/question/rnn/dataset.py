@@ -0,0 +1,243 @@
+""" dataset module defines the DatasetStore, an append-only store of labeled
+sentences for the question model. Appending labeled data only writes the new
+sentences (in a new shard) instead of rewriting the whole train and test
+sets.
+
+The store is a directory of shards (shard-000001.npz, ...), of a manifest
+(manifest.json) describing them and of an index of the hashes of the
+sentences (hashes.u64, to which the hashes of each new shard are appended). Each sentence is identified by a hash of
+its content: a sentence already in the store is not added again, and the
+hash decides whether the sentence goes to the train or the test set (unless
+the set is given when the sentence is appended, e.g. to import an existing
+split), so the split of a sentence never changes.
+
+The classes are:
+
+    DatasetStore            Append-only, deduplicated store of labeled sentences
+"""
+
+import os
+import re
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_FILE = 'manifest.json'
+HASH_INDEX_FILE = 'hashes.u64'
+SHARD_PATTERN = re.compile(r'^shard-(\d{6})\.npz$')
+
+# Precision of the split (fraction of the hashes in the test set)
+_SPLIT_RESOLUTION = 10000
+
+
+def sentence_hash(sentence):
+    """ Return the hash of a sentence (an unsigned 64 bits integer). """
+
+    digest = hashlib.blake2b(sentence.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class DatasetStore:
+    """ A DatasetStore object is an append-only store of labeled sentences
+    kept in a directory, split into a train and a test set by the hash of
+    the sentences (a fraction test_split of the hashes are in the test set).
+
+    Shuffling a set doesn't rewrite it: it changes the seed of the permutation
+    in which the sentences are loaded.
+
+    Methods:
+        append: Add the new sentences of a labeled dataset.
+        load: Return the sentences and labels of a set.
+        shuffle: Draw a new order in which the sets are loaded.
+        chars: Return the characters of the sentences.
+        export: Save a set to a csv file.
+    """
+
+    def __init__(self, dir, test_split=0.2):
+        self.dir = dir
+        self.test_split = test_split
+
+        os.makedirs(dir, exist_ok=True)
+        self._manifest = self._load_manifest()
+        self._hashes = None # Loaded from the index by the first append
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.dir, MANIFEST_FILE)
+
+    @property
+    def hash_index_file(self):
+        return os.path.join(self.dir, HASH_INDEX_FILE)
+
+    def _load_hashes(self):
+        """ Return the set of the hashes in the store, read from the index.
+        Hashes appended to the index by an append which didn't complete are
+        dropped, and a missing or short index is rebuilt from the shards.
+        """
+
+        count = len(self)
+        try:
+            hashes = np.fromfile(self.hash_index_file, dtype='<u8')
+        except FileNotFoundError:
+            hashes = np.array([], dtype='<u8')
+        if len(hashes) < count:
+            print(">>> Rebuilding the hash index of {}.".format(self.dir))
+            parts = [hashes[:0]]
+            for path in self.shards():
+                with np.load(path) as shard:
+                    parts.append(shard['hashes'].astype('<u8'))
+            hashes = np.concatenate(parts)
+            self._write_hash_index(hashes)
+        elif len(hashes) > count:
+            hashes = hashes[:count]
+            self._write_hash_index(hashes)
+        return set(hashes.tolist())
+
+    def _write_hash_index(self, hashes):
+        tmp_file = self.hash_index_file + '.tmp'
+        hashes.astype('<u8').tofile(tmp_file)
+        os.replace(tmp_file, self.hash_index_file)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_file, 'r', encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'test_split': self.test_split, 'seed': None, 'shards': []}
+
+    def _write_manifest(self):
+        """ Write the manifest atomically, so a shard is only part of the
+        store once it is completely written.
+        """
+
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as f:
+            json.dump(self._manifest, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _is_test(self, hashes):
+        threshold = self._manifest['test_split']*_SPLIT_RESOLUTION
+        return hashes % _SPLIT_RESOLUTION < threshold
+
+    def shards(self):
+        """ Return the paths of the shards, in order. """
+
+        return [os.path.join(self.dir, s['file']) for s in self._manifest['shards']]
+
+    def append(self, sentences, labels, source=None, split=None):
+        """ Add the sentences (with their labels) which aren't in the store
+        yet, in a new shard, and return the nbr of sentences added. source
+        (e.g. the labeled file) is kept in the manifest. The sentences go to
+        the split ('train' or 'test') if it is given, to the set given by
+        their hash otherwise.
+        """
+
+        if split not in (None, 'train', 'test'):
+            raise ValueError("Unknown split: {}".format(split))
+
+        if self._hashes is None:
+            self._hashes = self._load_hashes()
+
+        new_sentences, new_labels, new_hashes = [], [], []
+        for sentence, label in zip(sentences, labels):
+            sentence = str(sentence)
+            h = sentence_hash(sentence)
+            if h in self._hashes:
+                continue
+            self._hashes.add(h)
+            new_sentences.append(sentence)
+            new_labels.append(label)
+            new_hashes.append(h)
+        if len(new_sentences) == 0:
+            return 0
+
+        hashes = np.array(new_hashes, dtype=np.uint64)
+        if split is None:
+            test = self._is_test(hashes)
+        else:
+            test = np.full(len(hashes), split == 'test')
+        number = len(self._manifest['shards']) + 1
+        file_name = 'shard-{:06d}.npz'.format(number)
+        np.savez(
+            os.path.join(self.dir, file_name),
+            sentences=np.array(new_sentences, dtype=str),
+            labels=np.array(new_labels, dtype=np.int8),
+            hashes=hashes,
+            test=test
+        )
+        # The index is appended to before the manifest is written: hashes of
+        # a shard missing from the manifest are dropped when the index is read
+        with open(self.hash_index_file, 'ab') as f:
+            f.write(hashes.astype('<u8').tobytes())
+
+        self._manifest['shards'].append({
+            'file': file_name,
+            'source': source,
+            'count': len(new_sentences),
+            'test': int(test.sum()),
+            'chars': ''.join(sorted(set(''.join(new_sentences)))),
+        })
+        self._write_manifest()
+        return len(new_sentences)
+
+    def load(self, split=None, shuffled=True):
+        """ Return the sentences and labels (arrays) of the split ('train',
+        'test' or None for both), in the order of the last shuffle (in the
+        order they were appended if shuffled is False).
+        """
+
+        sentences, labels = [], []
+        for path in self.shards():
+            with np.load(path) as shard:
+                keep = slice(None)
+                if split == 'test':
+                    keep = shard['test']
+                elif split == 'train':
+                    keep = ~shard['test']
+                sentences.append(shard['sentences'][keep])
+                labels.append(shard['labels'][keep])
+        if len(sentences) == 0:
+            return np.array([], dtype=str), np.array([], dtype=np.int8)
+        sentences, labels = np.concatenate(sentences), np.concatenate(labels)
+
+        seed = self._manifest['seed']
+        if shuffled and seed is not None:
+            order = np.random.RandomState(seed).permutation(len(sentences))
+            sentences, labels = sentences[order], labels[order]
+        return sentences, labels
+
+    def shuffle(self, seed=None):
+        """ Draw a new order (or the order given by seed) in which the sets
+        are loaded. Nothing but the manifest is written.
+        """
+
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        self._manifest['seed'] = seed
+        self._write_manifest()
+
+    def chars(self):
+        """ Return the sorted list of the characters of the sentences. """
+
+        return sorted(set(''.join(s['chars'] for s in self._manifest['shards'])))
+
+    def export(self, split, file_name):
+        """ Save the sentences of the split to a csv file (with the columns
+        of the labeled files).
+        """
+
+        sentences, labels = self.load(split)
+        pd.DataFrame({'sentences': sentences, 'category': labels}).to_csv(
+            file_name, index=False
+        )
+
+    def __len__(self):
+        return sum(s['count'] for s in self._manifest['shards'])
+
+    def __repr__(self):
+        test = sum(s['test'] for s in self._manifest['shards'])
+        return "Dataset store in {} ({} train and {} test sentences).".format(
+            self.dir, len(self) - test, test
+        )
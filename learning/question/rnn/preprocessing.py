@@ -0,0 +1,93 @@
+""" Preprocessing of the chat messages for the question models. This module
+doesn't depend on tensorflow, so the messages can be prepared without loading
+it.
+
+The preparation of a message consists of the following steps:
+1) Split the message into sentences (including punctuation)
+2) Remove all accents
+3) put the sentence to lower
+and the sentences of many messages are deduplicated (keeping the order in
+which they first appear).
+
+The functions are:
+
+    split_sentences         Prepare the sentences of one message
+    iter_prepare            Yield the distinct prepared sentences of messages
+    prepare                 Return the distinct prepared sentences of messages
+"""
+
+import re
+from multiprocessing import Pool
+
+# Package to replace accents by their non-accent equivalent
+import unidecode
+
+_PUNCTUATION = re.compile(r'(\.+|\?+|\!+)')
+
+def split_sentences(message):
+    """ Return the prepared sentences of message, in order (a sentence may be
+    repeated).
+    """
+
+    message = unidecode.unidecode(message).lower().strip()
+    pieces = _PUNCTUATION.split(message)
+    sentences = []
+    for i in range(0, len(pieces), 2):
+        sent = ''.join(pieces[i: i + 2]).strip()
+        if len(sent) > 0:
+            sentences.append(sent)
+    return sentences
+
+def _iter_split(messages, processes=None, chunksize=256):
+    """ Yield the sentences of each message (in order). If processes is more
+    than 1, the messages are split by a pool of processes.
+    """
+
+    if processes is None or processes <= 1:
+        yield from map(split_sentences, messages)
+        return
+    with Pool(processes) as pool:
+        yield from pool.imap(split_sentences, messages, chunksize)
+
+def iter_prepare(messages, processes=None, chunksize=256):
+    """ Yield the distinct prepared sentences of the messages (an iterable of
+    strings, which may be a generator), in the order in which they first
+    appear. With processes > 1, the messages are split in chunks of chunksize
+    messages by a pool of processes, which pays off for large archives.
+    """
+
+    seen = set()
+    for sentences in _iter_split(messages, processes, chunksize):
+        for sent in sentences:
+            if sent not in seen:
+                seen.add(sent)
+                yield sent
+
+def prepare(messages, processes=None, provenance=False):
+    """ Return the list of the distinct prepared sentences of messages (a
+    string or a list of strings), in the order in which they first appear.
+
+    If provenance is True, return (sentences, sources) instead, where
+    sources[i] is the list of the indices of the messages in which
+    sentences[i] appears, so the predictions on the sentences can be mapped
+    back to the messages.
+    """
+
+    if isinstance(messages, str):
+        messages = [messages]
+
+    if not provenance:
+        return list(iter_prepare(messages, processes))
+
+    sentences, sources = [], []
+    index = {} # sentence -> position in sentences
+    for i, pieces in enumerate(_iter_split(messages, processes)):
+        for sent in pieces:
+            j = index.get(sent)
+            if j is None:
+                index[sent] = len(sentences)
+                sentences.append(sent)
+                sources.append([i])
+            elif sources[j][-1] != i:
+                sources[j].append(i)
+    return sentences, sources
@@ -1,4 +1,3 @@
-import re
 import os
 import json
 from configparser import ConfigParser
@@ -9,17 +8,21 @@ import tkinter
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 
 import numpy as np
-import pandas as pd
-from math import ceil
 
 # Keras
 from tensorflow.python.keras.utils import Sequence
 from tensorflow.python.keras.models import Model, load_model
 from tensorflow.python.keras.callbacks import ModelCheckpoint
-from tensorflow.python.keras.layers import Input, GRU, Dense, Dropout
+from tensorflow.python.keras.layers import Input, GRU, Dense, Dropout, Embedding, Masking
+from tensorflow.python.keras.initializers import Constant
 
-# Package to replace accents by their non-accent equivalent
-import unidecode
+# The preprocessing doesn't need tensorflow, so it lives in its own module
+try:
+    from .preprocessing import prepare
+    from .dataset import DatasetStore
+except ImportError: # Run as a script
+    from preprocessing import prepare
+    from dataset import DatasetStore
 
 # Load local config file
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -30,62 +33,115 @@ config['DEFAULT']['basedir'] = BASE_DIR # basedir is needed by other variables
 
 # ======================= Preprocessing functions =============================
 
-def prepare(messages):
-    """ The preparation of the message consists of the following steps:
-    1) Split the message into sentences (including punctuation)
-    2) Remove all accents
-    3) put the sentence to lower
+def encode_sentences(sentences, int_char_corr, maxlen=None):
+    """ Given sentences, return their codes: an int32 array of shape
+    (len(sentences), maxlen) where the code of a character is its integer
+    plus one and 0 is the padding after the end of a sentence.
     """
 
-    if not isinstance(messages, list):
-        messages = [messages]
+    if maxlen is None:
+        maxlen = config.getint('data', 'maxlen')
+    if len(sentences) == 0:
+        return np.zeros((0, maxlen), dtype=np.int32)
+
+    # Code points of the padded sentences, '\0' being the padding
+    padded = ''.join([sent[:maxlen].ljust(maxlen, '\0') for sent in sentences])
+    code_points = np.frombuffer(
+        padded.encode('utf-32-le'),
+        dtype=np.uint32
+    ).reshape(len(sentences), maxlen)
+
+    table = int_char_corr.code_table
+    codes = table[np.minimum(code_points, len(table) - 1)]
+    codes[code_points == 0] = 0
+    return codes
+
+def one_hot(codes, num_vocab):
+    """ Given codes (as returned by encode_sentences), return the one-hot
+    float32 tensor of shape codes.shape + (num_vocab,). The padding is
+    encoded by zero vectors.
+    """
 
-    sentences = []
-    for message in messages:
-        message = unidecode.unidecode(message).lower().strip()
-        pieces = re.split(r'(\.+|\?+|\!+)', message)
-        for i in range(0, len(pieces), 2):
-            sent = ''.join(pieces[i: i + 2]).strip()
-            if len(sent) > 0 and sent not in sentences:
-                sentences.append(sent)
-    return sentences
+    identity = np.eye(num_vocab + 1, dtype=np.float32)[:, 1:]
+    return identity[codes]
 
-def featurize_sentences(sentences, int_char_corr):
+def featurize_sentences(sentences, int_char_corr, sparse=False):
     """ Given sentences, compute their feature tensor and return it.
-    Each feature tensor has shape (maxlen, num_vocab).
+    Each feature tensor has shape (maxlen, num_vocab), or (maxlen,) if sparse
+    is True (the codes of the characters, see encode_sentences).
     """
 
-    maxlen = config.getint('data', 'maxlen')
-    
-    examples = np.zeros(
-        (len(sentences), maxlen, int_char_corr.num_vocab)
-    )
-
-    for i, sent in enumerate(sentences):
-        for j, c in enumerate(sent[:maxlen]):
-            examples[i, j, int_char_corr.to_int(c)] = 1
-
-    return examples
+    codes = encode_sentences(sentences, int_char_corr)
+    if sparse:
+        return codes
+    return one_hot(codes, int_char_corr.num_vocab)
 
 def unfeaturize_examples(examples, int_char_corr):
     """ Given a collection of training examples for the model, tranform them back into regular sentences.
     """
 
-    assert examples.shape[1:] == (config.getint('data', 'maxlen'), int_char_corr.num_vocab)
+    if examples.ndim == 3:
+        assert examples.shape[1:] == (config.getint('data', 'maxlen'), int_char_corr.num_vocab)
+        codes = np.argmax(examples, axis=-1) + 1
+        codes[examples.max(axis=-1) == 0] = 0
+    else:
+        codes = examples
 
     sentences = []
-    for example in examples:
+    for example in codes:
         sentences.append(''.join(
-                [int_char_corr.to_char(np.argmax(vec)) for vec in example]
+                [int_char_corr.to_char(code - 1) for code in example if code > 0]
             ).strip()
         )
 
     return sentences
 
-def featurize_messages(messages, int_char_corr):
+def is_sparse_model(model):
+    """ True if the model takes codes (see encode_sentences) as input instead
+    of one-hot tensors.
+    """
+
+    return len(model.input_shape) == 2
+
+def featurize_messages(messages, int_char_corr, sparse=False):
     """ Given messages, split them into sentences and featurize them. """
 
-    return featurize_sentences(prepare(messages), int_char_corr)
+    return featurize_sentences(prepare(messages), int_char_corr, sparse)
+
+def encode_dataset(store, split, int_char_corr, cache_file=None, maxlen=None):
+    """ Given a DatasetStore, return the codes of the sentences of the split
+    (see encode_sentences), their lengths and their labels.
+
+    The arrays are cached in cache_file (by default, <split>-codes.npz in the
+    directory of the store), which is used as long as the store has the same
+    shards and the cache was encoded with the same int-char correspondence
+    and maxlen. The order of the sentences is the order in which they were
+    appended (the Generator draws its own order).
+    """
+
+    if cache_file is None:
+        cache_file = os.path.join(store.dir, '{}-codes.npz'.format(split))
+    if maxlen is None:
+        maxlen = config.getint('data', 'maxlen')
+    intchar = json.dumps(int_char_corr.intchar, sort_keys=True)
+    shards = json.dumps([os.path.basename(path) for path in store.shards()])
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if ('shards' in cached and str(cached['shards']) == shards
+                    and int(cached['maxlen']) == maxlen
+                    and str(cached['intchar']) == intchar):
+                return cached['codes'], cached['lengths'], cached['labels']
+
+    sentences, labels = store.load(split, shuffled=False)
+    codes = encode_sentences(sentences.tolist(), int_char_corr, maxlen)
+    lengths = (codes > 0).sum(axis=1).astype(np.int32)
+    labels = labels.astype(np.float32)
+
+    np.savez(cache_file, codes=codes, lengths=lengths, labels=labels,
+             intchar=np.array(intchar), maxlen=np.array(maxlen),
+             shards=np.array(shards))
+    return codes, lengths, labels
 
 
 class IntCharCorr:
@@ -100,6 +156,13 @@ class IntCharCorr:
 
         self.charint = {c: i for i, c in self.intchar.items()}
 
+        # code_table[ord(c)] is the code of c (see encode_sentences). The last
+        # entry is the code of the characters outside the table.
+        size = max([ord(c) for c in self.charint] + [127]) + 2
+        self.code_table = np.full(size, self.to_int('') + 1, dtype=np.int32)
+        for c in self.charint:
+            self.code_table[ord(c)] = self.to_int(c) + 1
+
     def to_int(self, char):
         """ Given a character, return the corresponding integer or 0 (which
         corresponds to the space character) if the character is not in the
@@ -125,35 +188,72 @@ class IntCharCorr:
 
 
 class Generator(Sequence):
-    """ A Generator object generates batches of training examples out of the training set.
+    """ A Generator object generates batches of training examples out of a
+    split of a DatasetStore (the training set by default).
+
+    The set is encoded once (and cached, see encode_dataset). If
+    bucket is True, the sentences of a batch have similar lengths, and each
+    batch is only as long as its longest sentence. If shuffle is True, the
+    batches are drawn again (and in a new order) at each epoch.
+
+    The batches only depend on the index and the epoch, so they can be
+    prefetched by workers (see the workers argument of fit_generator).
     """
 
-    def __init__(self, data_file, int_char_corr, batch_size=32):
-        self.data_file = data_file
+    def __init__(self, store, int_char_corr, split='train', batch_size=32,
+                 sparse=False, bucket=True, shuffle=True, seed=None):
+        self.store = store
+        self.split = split
         self.int_char_corr = int_char_corr
         self.batch_size = batch_size
+        self.sparse = sparse
+        self.bucket = bucket
+        self.shuffle = shuffle
 
-        self.train = pd.read_csv(data_file)
-        self.sentences = self.train['sentences']
-        self.labels = self.train['category']
+        self.codes, self.lengths, self.labels = encode_dataset(
+            store, split, int_char_corr
+        )
+        self._random = np.random.RandomState(seed)
+        self._make_batches()
+
+    def _make_batches(self):
+        """ Split the indices of the examples into batches. """
+
+        n = len(self.labels)
+        if self.bucket:
+            # Sort by length (in random order among the sentences of a length)
+            ties = self._random.random_sample(n) if self.shuffle else np.arange(n)
+            order = np.lexsort((ties, self.lengths))
+        elif self.shuffle:
+            order = self._random.permutation(n)
+        else:
+            order = np.arange(n)
+
+        self.batches = [order[i: i + self.batch_size] for i in range(0, n, self.batch_size)]
+        if self.shuffle:
+            self._random.shuffle(self.batches)
 
     def __getitem__(self, idx):
-        batch = featurize_sentences(
-            self.sentences[idx*self.batch_size: (idx + 1)*self.batch_size],
-            self.int_char_corr
-        )
+        indices = self.batches[idx]
+        codes = self.codes[indices]
+        if self.bucket:
+            codes = codes[:, :max(1, self.lengths[indices].max())]
+        if not self.sparse:
+            codes = one_hot(codes, self.int_char_corr.num_vocab)
 
-        return batch, self.labels[idx*self.batch_size: (idx + 1)*self.batch_size]
+        return codes, self.labels[indices]
 
     def __len__(self):
-        return ceil(len(self.sentences)/self.batch_size)
+        return len(self.batches)
 
     def on_epoch_end(self):
-        pass
+        if self.shuffle:
+            self._make_batches()
 
     def __str__(self):
-        return "Generator on training set {} with batch size {} and length {}".format(
-            self.data_file,
+        return "Generator on the {} set of {} with batch size {} and length {}".format(
+            self.split,
+            self.store.dir,
             self.batch_size,
             len(self)
         )
@@ -161,9 +261,31 @@ class Generator(Sequence):
 
 # =========================== Defining function ===============================
 
-def export_model(model_file):
-    input = Input(shape = (None, int_char_corr.num_vocab))
-    gru_out = GRU(512)(input)
+def export_model(model_file, sparse=False):
+    """ Define the model and save it to model_file. If sparse is True, the
+    model takes the codes of the characters as input and computes their
+    one-hot vectors with a (fixed) embedding layer.
+
+    The padding (code 0, or a zero vector) is masked, so the GRU reads a
+    sentence the same way whether it is padded to maxlen (inference) or
+    to the length of its batch (training).
+    """
+
+    if sparse:
+        input = Input(shape = (None,), dtype='int32')
+        # Row 0 (the padding) is the zero vector, as in one_hot
+        identity = np.eye(int_char_corr.num_vocab + 1, dtype=np.float32)[:, 1:]
+        x = Embedding(
+            int_char_corr.num_vocab + 1,
+            int_char_corr.num_vocab,
+            embeddings_initializer=Constant(identity),
+            trainable=False,
+            mask_zero=True
+        )(input)
+    else:
+        input = Input(shape = (None, int_char_corr.num_vocab))
+        x = Masking(mask_value=0.)(input)
+    gru_out = GRU(512)(x)
     y = Dense(32, activation='relu')(gru_out)
     y = Dropout(0.5)(y)
     y = Dense(32, activation='relu')(y)
@@ -181,13 +303,28 @@ def export_model(model_file):
 
 # =========================== Training function ===============================
 
-def train_model(trained_file, int_char_corr, epochs, batch_size):
+def train_model(trained_file, int_char_corr, epochs, batch_size, workers=1,
+                use_multiprocessing=False):
+    """ Train the model saved in trained_file, the batches being prepared by
+    workers threads (or processes if use_multiprocessing is True) while the
+    model trains.
+    """
+
     model = load_model(trained_file)
 
+    store = DatasetStore(
+        config['data']['store'],
+        test_split=config.getfloat('training', 'testtrainsplit')
+    )
+    if len(store) == 0:
+        print(">>> The dataset store is empty (see the import mode of datagen).")
+        return
+
     generator = Generator(
-        config['data']['trainset'],
+        store,
         int_char_corr,
-        batch_size=batch_size
+        batch_size=batch_size,
+        sparse=is_sparse_model(model)
     )
 
     checkpoint_file = os.path.join(
@@ -210,18 +347,38 @@ def train_model(trained_file, int_char_corr, epochs, batch_size):
         generator,
         steps_per_epoch=len(generator),
         epochs=epochs,
-        callbacks=callbacks_list
+        callbacks=callbacks_list,
+        workers=workers,
+        use_multiprocessing=use_multiprocessing,
+        max_queue_size=2*max(1, workers)
     )
 
 
 # ========================== Inference function ===============================
 
+def load_best_model():
+    """ Load the best model (according to the config file). """
+
+    return load_model(config['model']['bestmodel'])
+
 def infer_from_model(model, message):
     """ Given a message, featurize it and use the model to predict if it is
     a question or not.
     """
 
-    return model.predict(featurize_messages(message, int_char_corr))
+    return model.predict(
+        featurize_messages(message, int_char_corr, is_sparse_model(model))
+    )
+
+def predict_sentences(model, sentences):
+    """ Given prepared sentences, featurize them and return the probability
+    that each of them is a question (a numpy array), with a single call to the
+    model.
+    """
+
+    return model.predict(
+        featurize_sentences(sentences, int_char_corr, is_sparse_model(model))
+    )[:, 0]
 
 
 int_char_corr = IntCharCorr(config['data']['intchar'])
@@ -242,12 +399,28 @@ if __name__ == "__main__":
         default=1,
         help="Number of epochs to train the model."
     )
+    parser.add_argument(
+        '--sparse',
+        action='store_true',
+        help="Export a model taking the codes of the characters as input."
+    )
     parser.add_argument(
         '--batch_size',
         type=int,
         default=32,
         help="Batch size."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of workers preparing the batches while training."
+    )
+    parser.add_argument(
+        '--multiprocessing',
+        action='store_true',
+        help="Prepare the batches in processes instead of threads."
+    )
 
     args = parser.parse_args()
 
@@ -261,7 +434,7 @@ if __name__ == "__main__":
                 initialdir=config['DEFAULT']['basedir'],
                 initialfile='model_definition'
             )
-        export_model(model_file)
+        export_model(model_file, args.sparse)
         print(">>> Model exported to {}".format(model_file))
     elif args.mode in ['train', 'infer', 'select']:
         trained_model_file = args.file
@@ -273,21 +446,17 @@ if __name__ == "__main__":
                 initialdir=config['model']['traineddir']
             )
         if args.mode == 'train':
-            train_model(trained_model_file,int_char_corr, args.epochs, args.batch_size)
+            train_model(trained_model_file, int_char_corr, args.epochs, args.batch_size,
+                        args.workers, args.multiprocessing)
         elif args.mode == 'select':
             config['model']['bestmodel'] = trained_model_file
             with open(CONFIG_FILE, 'w') as configfile:
                 config.write(configfile)
             print(">>> The new best model is {}".format(trained_model_file))
         else: # 'infer' mode
-            model = load_model(config['model']['bestmodel'])
+            model = load_best_model()
             while True:
                 message = input("Your message: ")
                 print(infer_from_model(model, message))
     else:
-        print(">>> Invalid mode.")
-else: # If the module is loaded, we load the best model
-    model = load_model(config['model']['bestmodel'])
-    
-    def rnn_predict(message):
-        return infer_from_model(model, message)
\ No newline at end of file
+        print(">>> Invalid mode.")
\ No newline at end of file
@@ -0,0 +1,408 @@
+""" server module defines an inference server, which keeps the question models
+loaded in its own process and serves their predictions to local clients (over
+a unix socket or a windows named pipe, with multiprocessing.connection). A
+slow prediction then doesn't block the chats, and several chats share a
+single loaded model.
+
+The clients must know the secret key of the server: the requests are
+unpickled, so anyone able to send one could run code in the server. The key
+is read from the BLITZCHAT_INFERENCE_KEY environment variable or from the key
+file of the config file, which the server generates with --generate-key.
+There is no default key: the server doesn't start without one.
+
+The requests of all the clients for a model are batched: they are predicted
+together as soon as max_batch inputs are waiting or the oldest request has
+waited max_delay seconds.
+
+To start a server (with the address and key file of the config file):
+
+    python -m learning.question.server --generate-key
+
+The classes are:
+
+    InferenceServer         Serve the predictions of the registered models
+    InferenceClient         Request predictions from an InferenceServer
+
+The auxilary functions are:
+
+    load_authkey            Return the secret key shared with the clients
+"""
+
+import os
+import sys
+import stat
+import time
+import tempfile
+import queue
+import threading
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from .models import registry, predictors
+
+# Read the config file
+config = ConfigParser()
+config.read(os.path.join(os.getcwd(), 'config.ini'))
+
+if sys.platform == 'win32':
+    _LOCAL_ADDRESS = r'\\.\pipe\blitzchat-inference'
+else:
+    _LOCAL_ADDRESS = os.path.join(
+        tempfile.gettempdir(), 'blitzchat-inference-{}.sock'.format(os.getuid())
+    )
+
+# A unix socket path or a named pipe (only reachable from this machine)
+INFERENCE_ADDRESS = config.get('inference', 'address', fallback=_LOCAL_ADDRESS)
+INFERENCE_KEY_FILE = config.get(
+    'inference', 'keyfile',
+    fallback=os.path.join(os.path.expanduser('~'), '.blitzchat-inference.key')
+)
+INFERENCE_KEY_VARIABLE = 'BLITZCHAT_INFERENCE_KEY'
+
+
+def load_authkey(key_file=INFERENCE_KEY_FILE, generate=False):
+    """ Return the secret key (bytes) shared by the server and its clients:
+    the BLITZCHAT_INFERENCE_KEY environment variable if it is set, otherwise
+    the content of key_file. If generate is True and there is no key, a
+    random one is written to key_file (readable by its owner only). Raises
+    RuntimeError if there is no key.
+    """
+
+    key = os.environ.get(INFERENCE_KEY_VARIABLE)
+    if key:
+        return key.encode('utf8')
+    try:
+        with open(key_file, 'r', encoding='utf8') as f:
+            key = f.read().strip()
+    except FileNotFoundError:
+        key = None
+    if not key and generate:
+        key = os.urandom(32).hex()
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(key)
+        print(">>> A new inference key was written to {}.".format(key_file))
+    if not key:
+        raise RuntimeError(
+            "No inference key: set {} or generate the key file {} "
+            "(python -m learning.question.server --generate-key)."
+            .format(INFERENCE_KEY_VARIABLE, key_file)
+        )
+    return key.encode('utf8')
+
+
+class _Request:
+    """ A request waiting to be predicted, with the connection to answer. """
+
+    __slots__ = ('conn', 'send_lock', 'id', 'inputs')
+
+    def __init__(self, conn, send_lock, id, inputs):
+        self.conn = conn
+        self.send_lock = send_lock
+        self.id = id
+        self.inputs = inputs
+
+    def reply(self, scores, error=None):
+        try:
+            with self.send_lock:
+                self.conn.send((self.id, scores, error))
+        except (OSError, EOFError): # The client is gone
+            pass
+
+
+class InferenceServer:
+    """ An InferenceServer serves the predictions of the models of
+    learning.question.predictors. A client sends (request id, model name,
+    list of inputs) and receives (request id, list of probabilities, error),
+    where error is None unless the prediction failed. The inputs are those
+    of the predictor (see learning.question.predictor_inputs).
+
+    The models are loaded when the server starts; a model which can't be
+    loaded (e.g. it was never trained) is reported and not served.
+
+    Each model has a thread predicting the waiting requests in batches of
+    at most max_batch inputs (a single request may be bigger), waiting at most
+    max_delay seconds for other requests to join a batch.
+
+    Methods:
+        serve_forever: Accept and serve the clients until closed.
+        close: Stop accepting clients.
+        stats: Return statistics about the batches of each model.
+    """
+
+    def __init__(self, address=INFERENCE_ADDRESS, authkey=None,
+                 models=None, max_batch=512, max_delay=0.01):
+        self.address = address
+        self.authkey = load_authkey() if authkey is None else authkey
+        self.models = list(predictors) if models is None else list(models)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._listener = None
+        self._queues = {name: queue.Queue() for name in self.models}
+        self._stats = {name: {'batches': 0, 'requests': 0, 'inputs': 0,
+                              'errors': 0, 'predict_seconds': 0.}
+                       for name in self.models}
+
+    def _collect(self, requests):
+        """ Return the requests of the next batch (None when closed). """
+
+        request = requests.get()
+        if request is None:
+            return None
+        batch, size = [request], len(request.inputs)
+        deadline = time.monotonic() + self.max_delay
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                requests.put(None) # Stop after this batch
+                break
+            batch.append(request)
+            size += len(request.inputs)
+        return batch
+
+    def _batch_loop(self, name):
+        predict = predictors[name]
+        stats = self._stats[name]
+        while True:
+            batch = self._collect(self._queues[name])
+            if batch is None:
+                return
+
+            inputs = [x for request in batch for x in request.inputs]
+            started = time.perf_counter()
+            try:
+                scores = [float(p) for p in predict(inputs)] if inputs else []
+                error = None
+            except Exception as e:
+                print(">>> The {} model failed to predict a batch.".format(name))
+                print(e)
+                scores, error = None, repr(e)
+                stats['errors'] += 1
+            stats['predict_seconds'] += time.perf_counter() - started
+            stats['batches'] += 1
+            stats['requests'] += len(batch)
+            stats['inputs'] += len(inputs)
+
+            i = 0
+            for request in batch:
+                n = len(request.inputs)
+                request.reply(None if error else scores[i: i + n], error)
+                i += n
+
+    def _serve(self, conn):
+        send_lock = threading.Lock()
+        try:
+            while True:
+                id, name, inputs = conn.recv()
+                requests = self._queues.get(name)
+                if requests is None:
+                    _Request(conn, send_lock, id, inputs).reply(
+                        None, "The model {} is not served.".format(name))
+                else:
+                    requests.put(_Request(conn, send_lock, id, list(inputs)))
+        except (OSError, EOFError): # The client left
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        """ Load the models, then accept and serve the clients until the
+        server is closed.
+        """
+
+        self._load_models()
+        for name in self.models:
+            threading.Thread(target=self._batch_loop, args=(name,), daemon=True).start()
+
+        self._listener = self._listen()
+        print("Serving {} on {}.".format(", ".join(self.models), self._listener.address))
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, AuthenticationError): # Closed, or a client failed to authenticate
+                if self._listener is None:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _load_models(self):
+        """ Load the models, and stop serving those which can't be loaded.
+        Raises RuntimeError if no model can be loaded.
+        """
+
+        loaded = []
+        for name in self.models:
+            try:
+                if name not in predictors:
+                    raise KeyError("there is no predictor called {}".format(name))
+                registry.get(name)
+            except Exception as e:
+                print(">>> The {} model is not available: {}".format(name, e))
+                del self._queues[name], self._stats[name]
+            else:
+                loaded.append(name)
+        if len(loaded) == 0:
+            raise RuntimeError("None of the models {} could be loaded.".format(
+                ", ".join(self.models)))
+        self.models = loaded
+
+    def _listen(self):
+        if isinstance(self.address, str) and not self.address.startswith('\\\\'):
+            # A unix socket: remove the one of a previous server, and only let
+            # the owner connect
+            try:
+                if stat.S_ISSOCK(os.stat(self.address).st_mode):
+                    os.remove(self.address)
+            except FileNotFoundError:
+                pass
+            umask = os.umask(0o077)
+            try:
+                return Listener(self.address, backlog=16, authkey=self.authkey)
+            finally:
+                os.umask(umask)
+        return Listener(self.address, backlog=16, authkey=self.authkey)
+
+    def close(self):
+        """ Stop accepting clients and stop the batch threads. """
+
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+        for requests in self._queues.values():
+            requests.put(None)
+
+    def stats(self):
+        """ Return the number of batches, requests, inputs and errors, the
+        mean batch size and the time spent predicting, for each model.
+        """
+
+        stats = {}
+        for name, s in self._stats.items():
+            stats[name] = dict(s)
+            stats[name]['mean_batch'] = s['inputs'] / s['batches'] if s['batches'] > 0 else None
+        return stats
+
+    def __repr__(self):
+        return "Inference server of {} on {}.".format(", ".join(self.models), self.address)
+
+
+class InferenceClient:
+    """ An InferenceClient requests predictions from an InferenceServer. It
+    connects on the first request and reconnects after a failure (but not
+    before retry_delay seconds). It can be shared by several threads.
+
+    Methods:
+        predict: Return the probabilities predicted by a model.
+        close: Close the connection.
+    """
+
+    def __init__(self, address=INFERENCE_ADDRESS, authkey=None, retry_delay=5):
+        self.address = address
+        self.authkey = load_authkey() if authkey is None else authkey
+        self.retry_delay = retry_delay
+
+        self._conn = None
+        self._failed_at = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is not None:
+            return
+        if (self._failed_at is not None
+                and time.monotonic() - self._failed_at < self.retry_delay):
+            raise ConnectionError("The inference server was unreachable.")
+        self._conn = Client(self.address, authkey=self.authkey)
+        self._failed_at = None
+
+    def predict(self, name, inputs, timeout=None):
+        """ Return the list of probabilities predicted by the model called
+        name on the inputs. Raise TimeoutError if the server didn't answer
+        within timeout seconds, ConnectionError if the server is unreachable
+        and RuntimeError if the prediction failed.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            try:
+                self._connect()
+                self._next_id += 1
+                id = self._next_id
+                self._conn.send((id, name, list(inputs)))
+                while True:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0 or not self._conn.poll(remaining):
+                        raise TimeoutError("The inference server didn't answer in time.")
+                    reply_id, scores, error = self._conn.recv()
+                    if reply_id == id: # Late answers to previous requests are dropped
+                        break
+            except TimeoutError:
+                raise
+            except (OSError, EOFError, AuthenticationError) as e:
+                self._close()
+                self._failed_at = time.monotonic()
+                raise ConnectionError("The inference server was unreachable.") from e
+
+        if error is not None:
+            raise RuntimeError(error)
+        return scores
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        """ Close the connection to the server. """
+
+        with self._lock:
+            self._close()
+
+    def __repr__(self):
+        return "Inference client of {}.".format(self.address)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve the predictions of the question models.")
+    parser.add_argument(
+        "--address", default=INFERENCE_ADDRESS,
+        help="Unix socket or named pipe of the server (default: {}).".format(INFERENCE_ADDRESS)
+    )
+    parser.add_argument(
+        "--generate-key", action='store_true',
+        help="Write a new key to {} if there is no key.".format(INFERENCE_KEY_FILE)
+    )
+    parser.add_argument(
+        "--models", nargs='+', default=list(predictors),
+        help="Models to serve (default: all of them)."
+    )
+    parser.add_argument(
+        "--max-batch", type=int, default=512,
+        help="Maximal nbr of inputs predicted at once."
+    )
+    parser.add_argument(
+        "--max-delay", type=float, default=0.01,
+        help="Maximal nbr of seconds a request waits for others to join its batch."
+    )
+    args = parser.parse_args()
+
+    try:
+        authkey = load_authkey(generate=args.generate_key)
+    except RuntimeError as e:
+        parser.exit(1, ">>> {}\n".format(e))
+    server = InferenceServer(args.address, authkey, models=args.models,
+                             max_batch=args.max_batch, max_delay=args.max_delay)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+        print(server.stats())
@@ -9,6 +9,7 @@ from configparser import ConfigParser
 from youtube.tools import *
 from youtube.chat import LiveChat
 from youtube.target import Session
+from youtube.sink import open_session_sink
 from youtube.filter import convert_to_local_time, delete_pattern
 
 # Read the config file
@@ -44,9 +45,16 @@ if __name__ == "__main__":
         exit(">>> The livechat attached to this livebroadcast is no longer active.")
 
     # Create a Session object where the messages will be stored and precessed
-    session = Session()
+    # (and streamed to a file while the chat runs)
+    session = Session(sink=open_session_sink(livebroadcast.title))
     session.add_filter(convert_to_local_time)
-    session.add_filter(delete_pattern(client, '#delete'))
+    # The moderator deletes the messages from its own thread, with its own
+    # service (the http object of a service is not thread safe)
+    moderator_client = get_authenticated_service(
+        config['auth']['secrets'],
+        CREDENTIALS
+    )
+    session.add_filter(delete_pattern(moderator_client, '#delete'))
        
     # Create the LiveChat object associated to the live broadcast
     livechat = LiveChat(client, livebroadcast.livechat_id, session)
@@ -55,6 +63,11 @@ if __name__ == "__main__":
     # Start the LiveChat, i.e. start requesting messages    
     livechat.start_refresh_loop()
 
+    # Complete the file to which the session was streamed
+    session.close()
+    if session.sink is not None:
+        session.save()
+
     # At this points, the live chat is over...
     tkinter.Tk().withdraw()
     file_name = tkinter.filedialog.asksaveasfilename(
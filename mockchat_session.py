@@ -10,6 +10,7 @@ from youtube.chat import *
 from youtube.tools import get_authenticated_service
 from youtube.filter import get_username, convert_to_local_time
 from youtube.target import Session
+from youtube.sink import open_session_sink
 
 # Read the config file
 config = ConfigParser()
@@ -18,8 +19,9 @@ config.read('config.ini')
 CREDENTIALS = "blitztutorat40"
 
 if __name__ == "__main__":
-    # Built a chat object
-    session = Session()
+    # Built a chat object (streamed to a file in pretty format while the chat
+    # runs, so that saving it only moves the file)
+    session = Session(sink=open_session_sink('mockchat', mode='pretty'))
     session.add_filter(convert_to_local_time)
 
     # Create the mockchat
@@ -31,9 +33,11 @@ if __name__ == "__main__":
     )
     mockchat = MockChat(ressources, session, speed=100) 
     print(mockchat)
-    print("The chat should last {} seconds.".format(mockchat.duration))
 
     mockchat.start_refresh_loop()
+    # The archive is loaded while it is replayed: the duration is only known
+    # (without loading the whole archive first) once the replay is over
+    print("The chat lasted {} seconds.".format(mockchat.duration))
     
     initialfile = os.path.splitext(os.path.split(ressources)[1])[0]
     save_file = tkinter.filedialog.asksaveasfilename(
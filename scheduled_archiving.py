@@ -12,6 +12,7 @@ import time
 from youtube.tools import *
 from youtube.chat import LiveChat
 from youtube.target import Session
+from youtube.sink import open_session_sink
 
 # Read the config file
 config = ConfigParser()
@@ -48,8 +49,9 @@ def archive_chat():
         print(">>> The livechat attached to this livebroadcast is no longer active.")
         return True
 
-    # Create the Chat object where the messages will be stored
-    session = Session()
+    # Create the Chat object where the messages will be stored (and streamed
+    # to a file while the chat runs)
+    session = Session(sink=open_session_sink(livebroadcast.title))
 
     # Create the LiveChat object associated to the live broadcast
     livechat = LiveChat(client, livebroadcast.livechat_id, session)
@@ -58,6 +60,11 @@ def archive_chat():
     # Start collecting messages until none are left...
     livechat.start_refresh_loop()
 
+    # Complete the file to which the session was streamed
+    session.close()
+    if session.sink is not None:
+        session.save()
+
     return True
     
 if __name__ == '__main__':
@@ -7,21 +7,39 @@ The classes are:
     Chat                    Represents a general chat, with its messages
     LiveChat(Thread)        Represents a chat associated with a youtube service
     MockChat(Thread)        Represents a chat constructed from a file
+    AsyncLiveChat(LiveChat) A LiveChat refreshed from an asyncio event loop
 
 The auxilary functions are:
 
+    follow_live_chats                   Refresh several AsyncLiveChat at once
+    iter_liveChatMessage_ressources     Merge backup files (lazily)
+    open_backup_log                     Open the backup log in a directory
+    iter_log_ressources                 Read a backup log (lazily)
+    combine_liveChatMessage_ressources  Merge backup files into a list
+    dump_ressources                     Write ressources to a json file
+    combine_live_chat_backups_in_dir    Merge the backups in a directory
 """
 
 from apiclient.errors import HttpError
 import threading
+import asyncio
 import datetime
 import time
 from dateutil.parser import parse as dateparser
 import json
 import re
 import os
+import heapq
+import operator
+import itertools
+import numpy as np
 from configparser import ConfigParser
 
+from .writer import BackgroundWriter
+from .metrics import metrics
+from .ressources import iter_ressources
+from .chatlog import SegmentLog, SEGMENT_PATTERN, INDEX_FILE
+
 # Read the config file
 config = ConfigParser()
 config.read(os.path.join(os.getcwd(), 'config.ini'))
@@ -30,8 +48,16 @@ LIVECHAT_BACKUP_DIR = config['livechat']['backup']
 LIVECHAT_BUFFER_SIZE = config.getint('livechat', 'buffsize')
 LIVECHAT_REFRESH_RATE = config.getint('livechat', 'refresh')
 LIVECHAT_BUFFER_HOLD = datetime.timedelta(seconds=config.getint('livechat', 'bufftimer'))
+LIVECHAT_WRITER_QUEUE = config.getint('livechat', 'writerqueue', fallback=16)
+LIVECHAT_SEGMENT_SIZE = config.getint('livechat', 'segmentsize', fallback=8*2**20)
+LIVECHAT_SEGMENT_AGE = config.getint('livechat', 'segmentage', fallback=3600)
+LIVECHAT_FSYNC_INTERVAL = config.getint('livechat', 'fsyncinterval', fallback=10)
+
+MOCKCHAT_BATCH_SIZE = config.getint('mockchat', 'batchsize', fallback=100)
+MOCKCHAT_LOAD_SIZE = config.getint('mockchat', 'loadsize', fallback=1000)
 
-MOCKCHAT_REFRESH_RATE = config.getint('livechat', 'refresh')
+# Speed of a MockChat replaying its messages as fast as possible
+MAX_SPEED = float('inf')
 
 def timestamp():
     """" Return a string of the form hhmmss representing the time now. """
@@ -48,21 +74,66 @@ def datetimestamp():
     now = now.replace(":","").replace(" ","_") # : is not allowed in windows file names.
     return now    
 
+def parse_rfc3339(date_string):
+    """ Return the (aware) datetime represented by date_string. Youtube gives
+    its timestamps in RFC 3339 format, which datetime.fromisoformat parses much
+    faster than dateutil. Other formats are still handed to dateutil.
+    """
+
+    try:
+        return datetime.datetime.fromisoformat(date_string.replace('Z', '+00:00'))
+    except ValueError:
+        return dateparser(date_string)
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+def epoch_microseconds(dt):
+    """ Return the number of microseconds between the epoch and dt. A naive dt
+    is assumed to be in local time.
+    """
+
+    if dt.tzinfo is None:
+        dt = dt.astimezone()
+    return (dt - _EPOCH) // _ONE_MICROSECOND
+
+def from_epoch_microseconds(us):
+    """ Inverse of epoch_microseconds: return the aware (UTC) datetime which is
+    us microseconds after the epoch.
+    """
+
+    return _EPOCH + datetime.timedelta(microseconds=us)
+
     
 class ChatMessage:
     """ A ChatMessage object represents a message in a Chat
 
     Attributes:
         author              Author of the message.
-        published_at        Moment at which the message was published.
+        published_at        Moment at which the message was published (str).
+        published_dt        published_at as a datetime (parsed only once).
+        published_us        published_at in microseconds since the epoch.
         content             Text content of the message.
         labels              A list of labels (strings) attached by classifiers.
+        scores              Confidence (float) of the classifiers, by label.
 
     Methods:
         add_label           Add a label (a string) to the message
         as_dict             Return a dictionary representing the message
     """
 
+    # Sessions can hold a lot of messages, so they don't get a __dict__
+    __slots__ = (
+        'id',
+        'author_channel_id',
+        '_published_at',
+        '_published_dt',
+        'content',
+        'author',
+        'labels',
+        'scores'
+    )
+
     def __init__(self, ressource):
         """ ChatMessage objects correspond to a youtube#liveChatMessage ressources.
         Such a ressource is represented by a dirctionnary in python and the init
@@ -74,6 +145,9 @@ class ChatMessage:
         message.author = 'Nicolas'
         message.published_at = datetime.datetime.now()
         message.content = 'Hello'        
+
+        The string published_at and the datetime published_dt are kept in
+        sync: setting one of them updates the other.
         """
 
         self.id = ressource.get('id', '')
@@ -83,11 +157,59 @@ class ChatMessage:
         self.content = snippet.get('textMessageDetails', {}).get('messageText', '')
         self.author = ressource.get('authorDetails', {}).get('displayName', self.author_channel_id)
         self.labels = []
+        self.scores = {}
+
+    @property
+    def published_at(self):
+        return self._published_at
+
+    @published_at.setter
+    def published_at(self, value):
+        if isinstance(value, datetime.datetime):
+            self.published_dt = value
+        else:
+            self._published_at = value
+            self._published_dt = None # Parsed when first needed
 
-    def add_label(self, label):
-        """ Add a label (a string) to the chat message. """
+    @property
+    def published_dt(self):
+        """ The moment at which the message was published, as a datetime.
+        Raises ValueError if published_at can't be parsed.
+        """
+
+        if self._published_dt is None:
+            self._published_dt = parse_rfc3339(self._published_at)
+        return self._published_dt
+
+    @published_dt.setter
+    def published_dt(self, dt):
+        self._published_at = str(dt)
+        self._published_dt = dt
+
+    def set_published(self, published_at, published_dt):
+        """ Set both published_at and published_dt, when they are already
+        known to represent the same moment (no parsing nor formatting).
+        """
+
+        self._published_at = published_at
+        self._published_dt = published_dt
+
+    @property
+    def published_us(self):
+        """ The moment at which the message was published, in microseconds
+        since the epoch.
+        """
+
+        return epoch_microseconds(self.published_dt)
+
+    def add_label(self, label, score=None):
+        """ Add a label (a string) to the chat message. If given, score is the
+        confidence of the classifier which attached the label.
+        """
 
         self.labels.append(label)
+        if score is not None:
+            self.scores[label] = score
 
     def as_dict(self):
         """ Returns the following dictionary:
@@ -97,16 +219,22 @@ class ChatMessage:
             "content": str
             "labels": [
                 str
-            ]
+            ],
+            "scores": {        (only if a label has a score)
+                str: float
+            }
         }
         """
 
-        return {
+        d = {
             'author': self.author,
             'published_at': self.published_at,
             'content': self.content,
             'labels': self.labels
         }
+        if self.scores:
+            d['scores'] = self.scores
+        return d
 
     def __repr__(self):
         """ Returns self.as_dict().__str__(). """
@@ -116,7 +244,7 @@ class ChatMessage:
     def __str__(self):
         # Remove microseconds when printing the message
         try:
-            published_time = dateparser(self.published_at).time().replace(microsecond=0)
+            published_time = self.published_dt.time().replace(microsecond=0)
         except ValueError as e:
             published_time = self.published_at
 
@@ -136,78 +264,264 @@ class MockChat:
         is_over: A booleann variable that is set when the chat is over.
         target: A target object where the chat messages are put.
         start_time: The time at which the chat started. This is the moment where the first message of the chat was posted.
+        position: Number of seconds of the archive already replayed.
+        speed: The speed of the replay (MAX_SPEED: as fast as possible).
+        is_paused: A boolean variable that is set while the chat is paused.
 
     Methods:
-        start: Start putting the chat messages in the Chat object.
+        start: Start putting the chat messages in the target (in a thread).
         duration: Estimated duration of the mock chat.
+        seek: Move the replay to a given number of seconds in the archive.
+        pause: Pause the replay.
+        resume: Resume the replay.
+        set_speed: Change the speed of the replay.
+        stop: Stop the replay.
         run: Starts making chat messages available until the chat is over.
         start_refresh_loop: calls the run method.
     """
 
     index = 0
     is_over = False
+    is_paused = False
 
-    def __init__(self, archive_file, target, speed=1):
+    def __init__(self, archive_file, target, speed=1, start=0):
         """ A mock chat is an object constructed from a list of ChatMessage
         whose purpose is to re-create the chat thread.
 
-        The constructor takes a list of ChatMessage objects and a refresh rate.
-        The refresh rate is the frequency at which the chat checks if new
-        chat messages are available. If speed is an integer different from one, play
-        the chat at speed times the speed.
+        The constructor takes the file of an archived chat and a target. If
+        speed is a positive number different from one, play the chat at speed
+        times the speed. If speed is MAX_SPEED, the messages are put in the
+        target as fast as possible, by batches of MOCKCHAT_BATCH_SIZE (to
+        benchmark the filters of a session for example). The replay starts
+        start seconds after the first message.
+
+        The archive (a json list or a json lines file) is read by chunks of
+        MOCKCHAT_LOAD_SIZE messages, when the replay reaches the end of what is
+        loaded, so the replay starts before the whole file is read. The offsets
+        (in microseconds) of the messages from the first one are kept in a
+        numpy array, so finding the messages to release is a binary search
+        whose cost doesn't depend on the size of the archive. Between two
+        releases, the chat sleeps until the next message is due.
+
+        The archive should be sorted by publishing time (as saved by
+        LiveChat.save_to_json). A message published before the previous one
+        is released with the previous one.
         """
 
         self.target = target
-        with open(archive_file, 'r', encoding='utf8') as f:
-            self._arch_mess = json.load(f) # List of liveChatMessage ressources
-
-        # Now self._arch_mess is a list of ChatMessage objects
-        self._arch_mess = [ChatMessage(ress) for ress in self._arch_mess]
-
-        try:
-            self.start_time = dateparser(self._arch_mess[0].published_at)
-        except IndexError:
+        self.archive_file = archive_file
+        self.load_size = MOCKCHAT_LOAD_SIZE
+        self.is_loaded = False
+        self.start_time = None
+        self._ressources = iter_ressources(archive_file)
+        self._arch_mess = [] # ChatMessage objects loaded so far
+        self._offsets = np.empty(self.load_size, dtype=np.int64)
+        self._first_us = None
+
+        self._load_more()
+        if self.nbr_messages == 0:
             print(">>> No messages in MockChat.")
-        if isinstance(speed, int):
+        if isinstance(speed, (int, float)) and speed > 0:
             self.speed = speed
         else:
             self.speed = 1
-        self.refresh_rate = MOCKCHAT_REFRESH_RATE
-        self.nbr_messages = len(self._arch_mess)
+        self.batch_size = MOCKCHAT_BATCH_SIZE
+
+        # The replay position is anchored at a moment (monotonic clock)
+        self._anchor_us = 0
+        self._anchor_clock = None
+        # Notified when the chat is paused, resumed, sped up, moved or stopped
+        self._control = threading.Condition()
+        self.seek(start)
+
+    @property
+    def nbr_messages(self):
+        """ The number of messages loaded so far. """
+
+        return len(self._arch_mess)
+
+    def _load_more(self):
+        """ Load the next chunk of the archive. Returns False if the archive
+        was already fully loaded.
+        """
+
+        if self.is_loaded:
+            return False
+        messages = [
+            ChatMessage(ress)
+            for ress in itertools.islice(self._ressources, self.load_size)
+        ]
+        if len(messages) < self.load_size:
+            self.is_loaded = True
+        if len(messages) == 0:
+            return True
+
+        offsets = np.array([mess.published_us for mess in messages], dtype=np.int64)
+        if self._first_us is None:
+            self._first_us = offsets[0]
+            self.start_time = messages[0].published_dt
+        offsets -= self._first_us
+        # The offsets must be sorted for the binary search
+        n = self.nbr_messages
+        if n > 0:
+            offsets[0] = max(offsets[0], self._offsets[n - 1])
+        offsets = np.maximum.accumulate(offsets)
+
+        if n + len(messages) > len(self._offsets):
+            grown = np.empty(max(n + len(messages), 2*len(self._offsets)), dtype=np.int64)
+            grown[:n] = self._offsets[:n]
+            self._offsets = grown
+        self._offsets[n: n + len(messages)] = offsets
+        self._arch_mess.extend(messages)
+        return True
+
+    def _load_until(self, position_us):
+        """ Load the archive until a message is published after position_us
+        (or until the whole archive is loaded).
+        """
+
+        while not self.is_loaded and (self.nbr_messages == 0
+                or self._offsets[self.nbr_messages - 1] < position_us):
+            self._load_more()
+
+    def _load_count(self, count):
+        """ Load the archive until count messages are loaded (or until the
+        whole archive is loaded).
+        """
+
+        while not self.is_loaded and self.nbr_messages < count:
+            self._load_more()
+
+    def _search(self, position_us):
+        """ Index of the first loaded message published at or after position_us. """
+
+        return int(np.searchsorted(
+            self._offsets[:self.nbr_messages], position_us, side='left'
+        ))
 
     @property
     def duration(self):
-        """ How long should the mock chat last, given its speed."""
+        """ How long should the mock chat last, given its speed. This loads the
+        whole archive.
+        """
 
-        span = (dateparser(self._arch_mess[-1].published_at)
-                - dateparser(self._arch_mess[0].published_at)).total_seconds()
-        return span / self.speed
-    
-    def _wait_to_refresh(self):
-        """ This function tries to wait for self.refresh_rate seconds and
-        catches KeyboardInterrupt exceptions. This allows the user to have more
-        control over the session...        
+        while self._load_more():
+            pass
+        if self.nbr_messages == 0:
+            return 0.
+        return self._offsets[self.nbr_messages - 1] / 1e6 / self.speed
+
+    def _position_us(self):
+        """ The position of the replay in the archive, in microseconds. """
+
+        if self._anchor_clock is None: # Not running or paused
+            return self._anchor_us
+        if self.speed == MAX_SPEED: # At the last message released
+            return max(self._anchor_us, int(self._offsets[self.index - 1]) + 1
+                       if self.index > 0 else 0)
+        elapsed = time.monotonic() - self._anchor_clock
+        return self._anchor_us + int(elapsed * self.speed * 1e6)
+
+    @property
+    def position(self):
+        """ Number of seconds of the archive already replayed. """
+
+        return self._position_us() / 1e6
+
+    def _reanchor(self, position_us):
+        """ Anchor the replay at position_us now (if it is running). """
+
+        self._anchor_us = position_us
+        if self._anchor_clock is not None:
+            self._anchor_clock = time.monotonic()
+
+    def set_speed(self, speed):
+        """ Change the speed (a positive number or MAX_SPEED) without moving
+        the replay position.
+        """
+
+        if not speed > 0:
+            raise ValueError("The speed of a mock chat must be positive.")
+        with self._control:
+            self._reanchor(self._position_us())
+            self.speed = speed
+            self._control.notify_all()
+
+    def seek(self, seconds):
+        """ Move the replay to seconds after the first message. The messages
+        published before that moment are skipped (or replayed again when
+        seeking backward).
         """
-        
-        try:
-            time.sleep(self.refresh_rate)
-        except KeyboardInterrupt:
-            print(">>> Mock chat interrupted.\n"
-                  ">>> Any positive integer entered will become the new speed.\n"
-                  ">>> Entering 0 will stop the chat.\n"
-                  ">>> Any other entry will make the chat resume. "
-            )
-            try:
-                n = int(input(">>> Your input: "))
-            except Exception:
-                pass
-            else:
-                if n == 0:
-                    print(">>> Stopping the chat.")
-                    self.is_over = True
-                elif 0 < n:
-                    print(">>> New speed is {}.".format(n))
-                    self.speed = n
+
+        with self._control:
+            self._reanchor(int(seconds * 1e6))
+            self._load_until(self._anchor_us)
+            self.index = self._search(self._anchor_us)
+            self.is_over = False
+            self._control.notify_all()
+
+    def pause(self):
+        """ Pause the replay. No messages are released until resume is called. """
+
+        with self._control:
+            if not self.is_paused:
+                self._anchor_us = self._position_us()
+                self._anchor_clock = None
+                self.is_paused = True
+                self._control.notify_all()
+
+    def resume(self):
+        """ Resume a paused replay where it was paused. """
+
+        with self._control:
+            if self.is_paused:
+                self._anchor_clock = time.monotonic()
+                self.is_paused = False
+                self._control.notify_all()
+
+    def stop(self):
+        """ Stop the replay (run returns after the current release). """
+
+        with self._control:
+            self.is_over = True
+            self._control.notify_all()
+
+    def _wait_to_refresh(self, timeout):
+        """ Wait until the next message is due (at most timeout seconds) or
+        until the replay is controlled (paused, resumed, ...).
+        """
+
+        with self._control:
+            if not self.is_over:
+                self._control.wait(timeout)
+
+    def _next_release(self):
+        """ Return the index up to which the messages should be released now
+        and the number of seconds until the next one is due.
+        """
+
+        if self.speed == MAX_SPEED:
+            self._load_count(self.index + self.batch_size)
+            return min(self.index + self.batch_size, self.nbr_messages), 0
+
+        position = self._position_us()
+        self._load_until(position)
+        index = self._search(position)
+        if index < self.nbr_messages:
+            wait = (self._offsets[index] - position + 1) / 1e6 / self.speed
+        else:
+            wait = 0
+        return max(self.index, index), wait
+
+    def start(self):
+        """ Run the replay in a new (daemon) thread and return the thread. The
+        replay can then be controlled with pause, resume, set_speed, seek and
+        stop.
+        """
+
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
 
     def start_refresh_loop(self):
         self.run()
@@ -215,28 +529,48 @@ class MockChat:
     def run(self):
         """ As the time passes, more messages are available in the MockChat.
         The run method makes those messages available (by putting them in
-        self.target). This loop can be interrupted via a KeyboardInterrupt 
-        exception.
+        self.target) until the chat is over or stopped. A KeyboardInterrupt
+        stops the chat.
         """
 
-        actual_start_time = datetime.datetime.now()
-
-        while not self.is_over:
-            delta = datetime.datetime.now() - actual_start_time
-            delta *= self.speed # Accelerate time
-
-            old_index = self.index
-            while self.index < self.nbr_messages \
-                and dateparser(self._arch_mess[self.index].published_at) < (self.start_time + delta):
-                self.index += 1
+        with self._control:
+            if not self.is_paused:
+                self._anchor_clock = time.monotonic()
+        released, started = 0, time.perf_counter()
 
-            if self.index == self.nbr_messages:
-                self.is_over = True
+        try:
+            while not self.is_over:
+                if self.is_paused:
+                    # With a timeout, so that a KeyboardInterrupt is caught
+                    self._wait_to_refresh(1)
+                    continue
+
+                # Release the messages published before the current position
+                with self._control:
+                    old_index = self.index
+                    self.index, wait = self._next_release()
+                    if self.is_loaded and self.index == self.nbr_messages:
+                        self.is_over = True
+
+                if old_index < self.index:
+                    self.target.extend_messages(self._arch_mess[old_index: self.index])
+                    released += self.index - old_index
+
+                if wait > 0:
+                    self._wait_to_refresh(wait)
+        except KeyboardInterrupt:
+            print(">>> Mock chat interrupted.")
+            self.stop()
 
-            if old_index < self.index:
-                self.target.extend_messages(self._arch_mess[old_index: self.index])
+        with self._control:
+            self._anchor_us = self._position_us()
+            self._anchor_clock = None
 
-            self._wait_to_refresh()
+        if self.speed == MAX_SPEED:
+            elapsed = time.perf_counter() - started
+            print(">>> {} messages replayed in {:.3f} s ({:.0f} messages/s).".format(
+                released, elapsed, released / elapsed if elapsed > 0 else float('inf')
+            ))
 
     def __repr__(self):
         return self.__str__()
@@ -262,24 +596,26 @@ class LiveChat:
         save_to_json: Save the LiveChat object.
     """
 
-    is_over = False
-    _buffer = []
-    _bkp_file_paths = []
-
-    def __init__(self, client, id, target, **kwargs):
+    def __init__(self, client, id, target, backup_dir=None, **kwargs):
         """ Initialize a LiveChat object.
 
         Arguments:
             client: An authenticated youtube service.
             id: the id of the live chat.
             target: a target in which the chat messages are put.
+            backup_dir: the directory in which the backup directory of the
+                chat is made (LIVECHAT_BACKUP_DIR by default).
         """
 
         self.target = target
         self.client = client
         self.id = id
+        self.is_over = False
         self.refresh_rate = LIVECHAT_REFRESH_RATE
-        self._bkp_dir = os.path.join(LIVECHAT_BACKUP_DIR, self.id)
+        self._buffer = []
+        if backup_dir is None:
+            backup_dir = LIVECHAT_BACKUP_DIR
+        self._bkp_dir = os.path.join(backup_dir, self.id)
         self._last_buffer_dump = datetime.datetime.now()
 
         try:
@@ -289,27 +625,68 @@ class LiveChat:
         else:
             print(">>> Directory {} created.".format(self._bkp_dir))
 
+        # The buffer is appended to the log by a background thread
+        self._log = open_backup_log(self._bkp_dir)
+        self._writer = BackgroundWriter(
+            self._append_to_log,
+            maxsize=LIVECHAT_WRITER_QUEUE,
+            name="LiveChat writer {}".format(self.id)
+        )
+        self._writer.start()
+
+        labels = {'chat': self.id}
+        self._requests_total = metrics.counter(
+            'livechat_requests_total', "Requests to youtube", labels)
+        self._http_errors_total = metrics.counter(
+            'livechat_http_errors_total', "Requests which failed", labels)
+        self._request_seconds = metrics.histogram(
+            'livechat_request_seconds', "Duration of the requests", labels)
+        self._messages_total = metrics.counter(
+            'livechat_messages_total', "Messages received", labels)
+        self._build_seconds = metrics.histogram(
+            'livechat_build_seconds', "Creation of the ChatMessage objects", labels)
+        self._target_seconds = metrics.histogram(
+            'livechat_target_seconds', "Putting a batch in the target", labels)
+
+    def _build_messages(self, ressources):
+        """ Return the ChatMessage objects of the ressources. """
+
+        self._messages_total.inc(len(ressources))
+        with self._build_seconds.time():
+            return [ChatMessage(ress) for ress in ressources]
+
     def dump_buffer_to_json(self):
         """ Every LiveChat object holds a buffer with all liveChatMessage
-        responses it recieved from youtube. This function dumps the buffer to a
-        json file (automatically named). After the live chat is over, those
-        backup files can be combined into a single chat ressource by calling
-        the save_to_json method.
+        responses it recieved from youtube. This function hands the buffer to
+        a background writer, which appends it to the backup log (a SegmentLog
+        in the backup directory), so that the chat keeps being refreshed during
+        the writing. After the live chat is over, the backups can be combined into
+        a single chat ressource by calling the save_to_json method.
         """
 
-        file_name = os.path.join(self._bkp_dir, datetimestamp())
-        
-        try:
-            with open(file_name, 'w', encoding='utf8') as f:
-                json.dump(self._buffer, f, ensure_ascii=False)
-        except Exception as e:
-            print(">>> There was a problem with dumping the live chat buffer.")
-            print(e)
-        else:
-            print(">>> Buffer dumped. ")
-            self._buffer = []
-            self._bkp_file_paths.append(file_name)
-            self._last_buffer_dump = datetime.datetime.now()
+        if len(self._buffer) > 0:
+            self._writer.put(self._buffer)
+        self._buffer = []
+        self._last_buffer_dump = datetime.datetime.now()
+
+    def _append_to_log(self, ressources):
+        """ Append the ressources to the backup log. Called by the background
+        writer.
+        """
+
+        self._log.append(ressources)
+        print(">>> Buffer dumped. ")
+
+    def close(self):
+        """ Dump the buffer and wait until all the backups are written. """
+
+        self.dump_buffer_to_json()
+        self._writer.close()
+        self._log.close()
+        stats = self._writer.stats()
+        if stats['blocked_puts'] > 0:
+            print(">>> The backups slowed the chat down {} times ({:.1f} s).".format(
+                stats['blocked_puts'], stats['blocked_seconds']))
 
     def save_to_json(self, file_name):
         """ Save to file_name. This method collects all backups made during the live chat into a single file.
@@ -323,12 +700,12 @@ class LiveChat:
         combine_live_chat_backups_in_dir function in this module.
         """
 
-        # Collecting the backups into a single list
-        messages = combine_liveChatMessage_ressources(self._bkp_file_paths)
+        # Read the backup log while writing it to file_name
+        self._writer.flush()
+        messages = iter_log_ressources(self._log)
 
         try:
-            with open(file_name, 'w', encoding='utf8') as f:
-                json.dump(messages, f, indent=4, ensure_ascii=False)
+            dump_ressources(messages, file_name)
         except Exception as e:
             print(">>> There was a problem with saving the live chat object.")
         else:
@@ -372,87 +749,347 @@ class LiveChat:
         )
 
         while request is not None and not self.is_over:
+            self._requests_total.inc()
             try:
-                response = request.execute()
+                with self._request_seconds.time():
+                    response = request.execute()
             except HttpError as e:
-                # e.content is of type byte
-                # e.content.decode() is a string representing a dict
-                # Use json.loads to make the string into a dict
-                e_info = json.loads(e.content.decode())
-                e_message = e_info['error']['message']
-
-                # if e_message == 'The live chat is no longer live.':
-                print(">>> An HTTP error {} occurred while refreshing the chat:\n{}"
-                    .format(e.resp.status, e_message)
-                )
-                print(">>> Closing the live chat.")
-                self.is_over = True
+                self._http_errors_total.inc()
+                self._close_on_http_error(e)
             else:
                 if len(response["items"]) > 0:
                     # Put messages in the chat
-                    self.target.extend_messages(
-                        [ChatMessage(ress) for ress in response["items"]]
-                    )
+                    messages = self._build_messages(response["items"])
+                    with self._target_seconds.time():
+                        self.target.extend_messages(messages)
 
-                    self._buffer.extend(response["items"])
-
-                    # Dump the buffer if it is too big
-                    if len(self._buffer) >= LIVECHAT_BUFFER_SIZE:
-                        self.dump_buffer_to_json()
-
-                    # Dump the buffer if it has been held for too long
-                    if datetime.datetime.now() - self._last_buffer_dump > LIVECHAT_BUFFER_HOLD:
+                    if self._buffer_ressources(response["items"]):
                         self.dump_buffer_to_json()
 
                 request = live_chat_messages.list_next(request, response)
                 self._wait_to_refresh()
-        self.dump_buffer_to_json()
+        self.close()
+
+    def _close_on_http_error(self, e):
+        """ Report the HttpError e raised while refreshing the chat and close
+        the chat.
+        """
+
+        # e.content is of type byte
+        # e.content.decode() is a string representing a dict
+        # Use json.loads to make the string into a dict
+        e_info = json.loads(e.content.decode())
+        e_message = e_info['error']['message']
+
+        # if e_message == 'The live chat is no longer live.':
+        print(">>> An HTTP error {} occurred while refreshing the chat:\n{}"
+            .format(e.resp.status, e_message)
+        )
+        print(">>> Closing the live chat.")
+        self.is_over = True
+
+    def _buffer_ressources(self, ressources):
+        """ Put the ressources in the buffer and return True if the buffer
+        should now be dumped, i.e. if it is too big or if it has been held for
+        too long.
+        """
+
+        self._buffer.extend(ressources)
+        return (len(self._buffer) >= LIVECHAT_BUFFER_SIZE
+            or datetime.datetime.now() - self._last_buffer_dump > LIVECHAT_BUFFER_HOLD)
 
     def __repr__(self):
         return "Live Chat with id {}.".format(self.id)
 
 
+class AsyncLiveChat(LiveChat):
+    """ An AsyncLiveChat object is a LiveChat which is refreshed from an
+    asyncio event loop. Instead of waiting a fixed refresh rate, each request
+    is scheduled after the pollingIntervalMillis returned by youtube with the
+    previous response. The messages go through an asyncio queue before being
+    put in the target, so a slow target doesn't delay the next request.
+
+    Several AsyncLiveChat objects can be followed from the same event loop with
+    the follow_live_chats function. Since the http object of a youtube service
+    is not thread safe, each chat should use its own authenticated service.
+
+    Attributes:
+        is_over: A booleann variable that is set when the chat is over.
+        target: A target object where the chat messages are put.
+        id: id of the livechat
+
+    Methods:
+        run_async: Coroutine refreshing the chat until it is over.
+        dump_buffer_to_json: Dump the buffer in json format
+        save_to_json: Save the LiveChat object.
+    """
+
+    def __init__(self, client, id, target, queue_size=0, **kwargs):
+        """ Initialize an AsyncLiveChat object.
+
+        Arguments:
+            client: An authenticated youtube service.
+            id: the id of the live chat.
+            target: a target in which the chat messages are put.
+            queue_size: maximum number of batches of messages waiting to be
+                put in the target (0 means no limit).
+        """
+
+        super().__init__(client, id, target, **kwargs)
+        self.queue_size = queue_size
+
+    def _polling_interval(self, response):
+        """ Number of seconds to wait before the next request, as asked by
+        youtube in response (or the refresh rate if youtube didn't say).
+        """
+
+        millis = response.get('pollingIntervalMillis')
+        if millis is None:
+            return self.refresh_rate
+        return millis / 1000
+
+    async def _poll(self, queue):
+        """ Request the new messages until the chat is over and put them in
+        queue. None is put in the queue when the chat is over.
+        """
+
+        loop = asyncio.get_running_loop()
+        live_chat_messages = self.client.liveChatMessages()
+        request = live_chat_messages.list(
+            liveChatId=self.id,
+            part="id, snippet, authorDetails"
+        )
+
+        try:
+            while request is not None and not self.is_over:
+                requested_at = loop.time()
+                self._requests_total.inc()
+                try:
+                    response = await loop.run_in_executor(None, request.execute)
+                except HttpError as e:
+                    self._http_errors_total.inc()
+                    self._close_on_http_error(e)
+                else:
+                    self._request_seconds.observe(loop.time() - requested_at)
+                    if len(response["items"]) > 0:
+                        await queue.put(self._build_messages(response["items"]))
+
+                        if self._buffer_ressources(response["items"]):
+                            await loop.run_in_executor(None, self.dump_buffer_to_json)
+
+                    request = live_chat_messages.list_next(request, response)
+                    await asyncio.sleep(max(0,
+                        requested_at + self._polling_interval(response) - loop.time()
+                    ))
+        finally:
+            await queue.put(None)
+
+    async def _deliver(self, queue):
+        """ Put the batches of messages of queue in the target until None is
+        found in the queue.
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            messages = await queue.get()
+            if messages is None:
+                return
+            with self._target_seconds.time():
+                await loop.run_in_executor(None, self.target.extend_messages, messages)
+
+    async def run_async(self):
+        """ Refresh the chat until it is over, then dump the buffer. The buffer
+        is also dumped (and written) if the coroutine is cancelled, by the
+        executor so that the other chats of the event loop don't wait for it.
+        """
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        try:
+            await asyncio.gather(self._poll(queue), self._deliver(queue))
+        finally:
+            await loop.run_in_executor(None, self.close)
+
+    def run(self):
+        """ Refresh the chat in its own event loop until it is over. """
+
+        asyncio.run(self.run_async())
+
+    def __repr__(self):
+        return "Async live Chat with id {}.".format(self.id)
+
+
+def follow_live_chats(livechats):
+    """ Refresh all the AsyncLiveChat objects in livechats from a single event
+    loop and return when they are all over.
+    """
+
+    async def follow():
+        await asyncio.gather(*[livechat.run_async() for livechat in livechats])
+
+    asyncio.run(follow())
+
+def _published_key(ressource):
+    """ Sort key of a liveChatMessage ressource: the moment it was published. """
+
+    return parse_rfc3339(ressource['snippet']['publishedAt'])
+
+def _published_us_key(ressource):
+    """ Key of a liveChatMessage ressource in the index of the backup logs. """
+
+    return epoch_microseconds(_published_key(ressource))
+
+def _is_sorted(file):
+    """ Return True if the ressources in file are in publishing order (the
+    file is read one ressource at a time).
+    """
+
+    last = None
+    for ress in iter_ressources(file):
+        key = _published_key(ress)
+        if last is not None and key < last:
+            return False
+        last = key
+    return True
+
+def _iter_ressource_file(file, is_sorted=None):
+    """ Yield the pairs (publishing time, ressource) of the liveChatMessage
+    ressources saved in file, in publishing order. The file is only opened
+    when the first ressource is requested.
+
+    A file in publishing order (is_sorted True, or checked by a first pass if
+    is_sorted is None) is streamed one ressource at a time; only a file out
+    of order is loaded and sorted.
+    """
+
+    try:
+        if is_sorted is None:
+            is_sorted = _is_sorted(file)
+        if is_sorted:
+            last = None
+            for ress in iter_ressources(file):
+                key = _published_key(ress)
+                if last is not None and key < last:
+                    print(">>> The file {} is not in publishing order.".format(file))
+                last = key
+                yield key, ress
+            return
+        keyed = [(_published_key(ress), ress) for ress in iter_ressources(file)]
+    except Exception as e:
+        print(">>> There was a problem with loading the file {}.".format(file))
+        print(e)
+        return
+
+    keyed.sort(key=operator.itemgetter(0))
+    yield from keyed
+
+def _merge_runs(files, seen, sorted_files=()):
+    """ Merge the runs of ressources in files, skipping the messages whose
+    id is in the set seen (which is updated). The files in sorted_files are
+    known to be in publishing order; the others are checked.
+    """
+
+    runs = [_iter_ressource_file(file, True if file in sorted_files else None)
+            for file in files]
+    for _, ress in heapq.merge(*runs, key=operator.itemgetter(0)):
+        mess_id = ress.get('id')
+        if mess_id is not None:
+            if mess_id in seen:
+                continue
+            seen.add(mess_id)
+        yield ress
+
+def iter_liveChatMessage_ressources(files, sorted_files=()):
+    """ Merge the youtube liveChatMessage ressources in the files and yield
+    them one at a time, sorted by publishing time. Each file is a run, streamed
+    if it is already sorted, and the runs are merged (k-way), so that the cost
+    is O(n log k) for n messages in k files and only a chunk of each file is
+    held in memory. Duplicates are detected with the id of the messages. The
+    files in sorted_files are known to be sorted (the others are checked).
+    """
+
+    return _merge_runs(files, set(), sorted_files)
+
+def open_backup_log(dir, read_only=False):
+    """ Open (and recover if needed) the SegmentLog of live chat backups in
+    the directory dir. A log only opened to be read (read_only True) is
+    never recovered, since its chat may still be writing to it.
+    """
+
+    return SegmentLog(
+        dir,
+        key=_published_us_key,
+        max_bytes=LIVECHAT_SEGMENT_SIZE,
+        max_age=LIVECHAT_SEGMENT_AGE,
+        fsync_interval=LIVECHAT_FSYNC_INTERVAL,
+        read_only=read_only
+    )
+
+def iter_log_ressources(log):
+    """ Yield the liveChatMessage ressources of the SegmentLog log, sorted by
+    publishing time and without duplicates. The segments are read one after
+    the other; only the segments whose publishing times overlap (according to
+    the index of the log) are merged together.
+    """
+
+    log.sync() # The current segment may have buffered records
+    seen = set()
+    sorted_files = log.sorted_segments()
+    for group in log.groups():
+        yield from _merge_runs(group, seen, sorted_files)
+
 def combine_liveChatMessage_ressources(files):
     """ Combine the lists of youtube liveChatMessage ressources in the files
     into a single list and return the list.
     """
 
-    # Collecting the backups into a single list called json_object
-    messages = []
-    for file in files:
-        try:
-            with open(file, 'r', encoding='utf8') as f:
-                new_messages = json.load(f)
-        except Exception as e:
-            print(">>> There was a problem with loading the file {}.".format(file))
-            print(e)
-        else:
-            # Keep only the messages not already in messages
-            new_messages = [mess for mess in new_messages if mess not in messages]
-            messages.extend(new_messages)
-
-    # Sort according to time
-    messages = sorted(
-        messages,
-        key=(lambda mess: dateparser(mess.get('snippet').get('publishedAt')))
-    )
+    return list(iter_liveChatMessage_ressources(files))
+
+def dump_ressources(ressources, file_name):
+    """ Write the ressources (any iterable) to file_name as a json list, one
+    ressource at a time. The output is the same as the one of json.dump with
+    indent=4, but the ressources are never all held in memory.
+    Returns the number of ressources written.
+    """
 
-    return messages
+    count = 0
+    with open(file_name, 'w', encoding='utf8') as f:
+        f.write('[')
+        for ress in ressources:
+            f.write(',\n    ' if count else '\n    ')
+            f.write(
+                json.dumps(ress, indent=4, ensure_ascii=False)
+                .replace('\n', '\n    ')
+            )
+            count += 1
+        f.write('\n]' if count else ']')
+    return count
 
 def combine_live_chat_backups_in_dir(dir, file_name):
     """ Combines all the live chat backups in the directory dir and saves it
-    in file_name (as a json object).
+    in file_name (as a json object). The backup log is read sequentially,
+    unless the directory also holds older backup files, which are then merged
+    with the segments of the log.
     """
 
-    files = [os.path.join(dir, file) for file in os.listdir(dir)]
-    json_object = combine_liveChatMessage_ressources(files)
+    # Backups written before the backup logs are merged with the log
+    files = [
+        os.path.join(dir, file) for file in os.listdir(dir)
+        if file != INDEX_FILE and not file.endswith('.tmp')
+        and not SEGMENT_PATTERN.match(file)
+    ]
+    log = open_backup_log(dir, read_only=True)
+    if len(files) == 0:
+        ressources = iter_log_ressources(log)
+    else:
+        ressources = iter_liveChatMessage_ressources(
+            files + log.segments(), log.sorted_segments()
+        )
 
-    # Dump json_object
     try:
-        with open(file_name, 'w', encoding='utf8') as f:
-            json.dump(json_object, f, indent=4, ensure_ascii=False)
+        dump_ressources(ressources, file_name)
     except Exception as e:
         print(">>> There was a problem with saving the chat object.")
         print(e)
-    print(">>> Succesfully saved to ressource to {}.".format(file_name))
-
+    else:
+        print(">>> Succesfully saved to ressource to {}.".format(file_name))
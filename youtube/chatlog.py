@@ -0,0 +1,330 @@
+""" chatlog module defines the SegmentLog class, an append-only log of json
+records used by the live chats to backup the messages they receive.
+
+The log is a directory of segments (segment-000001.jsonl, ...) holding one
+json record per line and of an index (index.json) describing the segments.
+
+The classes are:
+
+    SegmentLog              Append-only log of json records, split in segments
+"""
+
+import os
+import re
+import json
+import time
+import threading
+
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.jsonl$')
+INDEX_FILE = 'index.json'
+
+
+def segment_name(number):
+    """ Return the file name of the segment with the given number. """
+
+    return 'segment-{:06d}.jsonl'.format(number)
+
+def _valid_length(data):
+    """ Return the length of the longest prefix of data (bytes) made of
+    complete json records, each ending with a new line.
+    """
+
+    end = 0
+    while True:
+        newline = data.find(b'\n', end)
+        if newline == -1:
+            return end
+        line = data[end:newline]
+        if line.strip():
+            try:
+                json.loads(line.decode('utf8'))
+            except ValueError:
+                return end
+        end = newline + 1
+
+
+class SegmentLog:
+    """ A SegmentLog object is an append-only log of json records (one record
+    per line) kept in a directory. A new segment is started when the current
+    one is too big or too old, and the records are fsynced in batches (at most
+    every fsync_interval seconds, and when a segment is closed).
+
+    When a log is opened, a record torn by a crash at the end of the last
+    segment is truncated, and the index is rebuilt if it is missing. A log
+    opened with read_only True (e.g. to read the log of a chat which may
+    still be writing to it) writes nothing: its index is rebuilt in memory
+    and a torn record at the end of a segment is skipped.
+
+    Attributes:
+        dir: The directory of the log.
+        key: Function giving a number (e.g. a time) for each record. The index
+            keeps the smallest and largest key of each segment.
+        read_only: True if the log can't be appended to.
+
+    Methods:
+        append: Append a list of records to the log.
+        sync: Flush and fsync the current segment.
+        close: Close the current segment.
+        segments: List the paths of the segments, in order.
+        iter_records: Iterate over the records, in order.
+        groups: Group the segments whose keys overlap.
+    """
+
+    def __init__(self, dir, key=None, max_bytes=8*2**20, max_age=3600,
+                 fsync_interval=10, read_only=False):
+        self.dir = dir
+        self.key = key
+        self.read_only = read_only
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+
+        self._file = None       # Current segment (opened in append mode)
+        self._entry = None      # Index entry of the current segment
+        self._opened_at = None
+        self._last_fsync = None
+        self._lock = threading.Lock()
+
+        if not read_only:
+            os.makedirs(dir, exist_ok=True)
+        self._index = self._load_index()
+        self._recover()
+
+    @property
+    def index_file(self):
+        return os.path.join(self.dir, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _write_index(self):
+        """ Write the index atomically (a crash leaves the old or the new
+        index, never half of one).
+        """
+
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as f:
+            json.dump(self._index, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.index_file)
+
+    def _scan(self, file_name):
+        """ Return a fresh index entry for the segment file_name. A torn
+        record at the end of the segment (a line without its new line) is
+        left out of the entry.
+        """
+
+        entry = {'file': file_name, 'count': 0, 'bytes': 0,
+                 'first': None, 'last': None, 'sorted': True}
+        with open(os.path.join(self.dir, file_name), 'r', encoding='utf8',
+                  newline='') as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        if line.endswith('\n'):
+                            raise
+                        break
+                    self._update_entry(entry, record)
+                entry['bytes'] += len(line.encode('utf8'))
+        return entry
+
+    def _update_entry(self, entry, record):
+        entry['count'] += 1
+        if self.key is not None:
+            k = self.key(record)
+            if entry['last'] is not None and k < entry['last']:
+                entry['sorted'] = False
+            if entry['first'] is None or k < entry['first']:
+                entry['first'] = k
+            if entry['last'] is None or k > entry['last']:
+                entry['last'] = k
+
+    def _recover(self):
+        """ Truncate a torn record at the end of the last segment and index
+        the segments missing from the index. A read only log only indexes
+        the segments in memory (leaving out a torn record, see _scan).
+        """
+
+        files = sorted(f for f in os.listdir(self.dir) if SEGMENT_PATTERN.match(f))
+        indexed = {entry['file']: entry for entry in self._index}
+        changed = len(indexed) != len(self._index) or set(indexed) - set(files)
+
+        if len(files) > 0 and not self.read_only:
+            last = os.path.join(self.dir, files[-1])
+            with open(last, 'rb') as f:
+                data = f.read()
+            valid = _valid_length(data)
+            if valid < len(data):
+                print(">>> Truncating a torn record at the end of {}.".format(last))
+                with open(last, 'r+b') as f:
+                    f.truncate(valid)
+                    f.flush()
+                    os.fsync(f.fileno())
+                indexed.pop(files[-1], None)
+
+        self._index = []
+        for file_name in files:
+            entry = indexed.get(file_name)
+            size = os.path.getsize(os.path.join(self.dir, file_name))
+            if entry is None or entry['bytes'] != size:
+                entry = self._scan(file_name)
+                changed = True
+            self._index.append(entry)
+        if changed and not self.read_only:
+            self._write_index()
+
+    def _next_number(self):
+        if len(self._index) == 0:
+            return 1
+        return int(SEGMENT_PATTERN.match(self._index[-1]['file']).group(1)) + 1
+
+    def _open_segment(self):
+        file_name = segment_name(self._next_number())
+        self._file = open(os.path.join(self.dir, file_name), 'a',
+                          encoding='utf8', newline='')
+        self._entry = {'file': file_name, 'count': 0, 'bytes': 0,
+                       'first': None, 'last': None, 'sorted': True}
+        self._index.append(self._entry)
+        self._opened_at = self._last_fsync = time.monotonic()
+        self._write_index()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = self._entry = None
+            self._write_index()
+
+    def _flush(self):
+        """ Write the buffered records of the current segment (without
+        waiting for the disk).
+        """
+
+        if self._file is not None:
+            self._file.flush()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def append(self, records):
+        """ Append the records (a list of json serializable objects) to the log,
+        starting a new segment if needed. The records are written with a
+        single write and fsynced if the last fsync is too old.
+        """
+
+        if self.read_only:
+            raise ValueError("The log in {} is read only.".format(self.dir))
+        data = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records)
+        with self._lock:
+            if self._file is not None and (
+                    self._entry['bytes'] >= self.max_bytes
+                    or time.monotonic() - self._opened_at >= self.max_age):
+                self._close_segment()
+            if self._file is None:
+                self._open_segment()
+
+            self._file.write(data)
+            self._entry['bytes'] += len(data.encode('utf8'))
+            for record in records:
+                self._update_entry(self._entry, record)
+
+            if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._sync()
+                self._write_index()
+
+    def sync(self):
+        """ Flush and fsync the current segment and write the index (nothing
+        is done if the log is read only).
+        """
+
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._write_index()
+
+    def close(self):
+        """ Close the current segment. Appending again starts a new one. """
+
+        with self._lock:
+            self._close_segment()
+
+    def segments(self):
+        """ Return the paths of the segments, in order. The records buffered
+        for the current segment are written first, so reading the segments
+        gives all the records appended so far.
+        """
+
+        with self._lock:
+            self._flush()
+            return [os.path.join(self.dir, e['file']) for e in self._index]
+
+    def groups(self):
+        """ Return the paths of the segments grouped so that the keys of two
+        segments in different groups don't overlap (and the groups are in
+        order of keys). Without a key, all the segments are in one group.
+        As for segments, the buffered records are written first.
+        """
+
+        with self._lock:
+            self._flush()
+            entries = [dict(e) for e in self._index if e['count'] > 0]
+        if self.key is None:
+            return [[os.path.join(self.dir, e['file']) for e in entries]]
+
+        entries.sort(key=lambda e: e['first'])
+        groups, last = [], None
+        for entry in entries:
+            path = os.path.join(self.dir, entry['file'])
+            if last is not None and entry['first'] <= last:
+                groups[-1].append(path)
+                last = max(last, entry['last'])
+            else:
+                groups.append([path])
+                last = entry['last']
+        return groups
+
+    def sorted_segments(self):
+        """ Return the set of the paths of the segments whose records were
+        appended in order of keys (segments indexed before this was recorded
+        are not in the set).
+        """
+
+        with self._lock:
+            return {
+                os.path.join(self.dir, e['file'])
+                for e in self._index if e.get('sorted') is True
+            }
+
+    def iter_records(self):
+        """ Iterate over all the records of the log, segment by segment. A
+        torn record at the end of a segment is skipped.
+        """
+
+        self.sync()
+        for path in self.segments():
+            with open(path, 'r', encoding='utf8') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            if line.endswith('\n'):
+                                raise
+                            break
+                        yield record
+
+    def __len__(self):
+        with self._lock:
+            return sum(entry['count'] for entry in self._index)
+
+    def __repr__(self):
+        return "Segment log in {} ({} segments).".format(self.dir, len(self._index))
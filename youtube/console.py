@@ -0,0 +1,118 @@
+""" console module defines the ConsoleRenderer, which prints the chat messages
+by batches: a batch is formatted into a single string and written at once,
+instead of calling print for each message.
+
+The classes are:
+
+    ConsoleRenderer         Prints batches of messages, maybe from a thread
+"""
+
+import sys
+import threading
+import atexit
+from collections import deque
+
+
+class ConsoleRenderer:
+    """ A ConsoleRenderer prints batches of messages to a stream (the console
+    by default), each batch with a single write.
+
+    If threaded is True, the batches are printed by a background thread, so
+    a slow terminal doesn't delay the chat. When more than max_pending
+    messages wait to be printed, the oldest are dropped and replaced by a
+    line telling how many were dropped.
+
+    Methods:
+        render: Print a batch of messages.
+        flush: Wait until the batches given so far are printed.
+        close: Print the waiting batches and stop the thread.
+    """
+
+    def __init__(self, stream=None, threaded=False, max_pending=1000):
+        self.stream = stream
+        self.threaded = threaded
+        self.max_pending = max_pending
+        self.printed = self.dropped = 0
+
+        self._pending = deque()   # Messages waiting to be printed
+        self._dropped = 0         # Dropped since the last write
+        self._writing = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._thread = None
+        if threaded:
+            self._thread = threading.Thread(target=self._print_loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _write(self, messages, dropped=0):
+        lines = []
+        if dropped > 0:
+            lines.append(">>> {} messages were not printed.".format(dropped))
+        lines.extend(str(message) for message in messages)
+        if len(lines) == 0:
+            return
+        stream = sys.stdout if self.stream is None else self.stream
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+        self.printed += len(messages)
+
+    def render(self, messages):
+        """ Print the messages (a list), now or by the thread. """
+
+        if not self.threaded:
+            self._write(messages)
+            return
+        with self._lock:
+            self._pending.extend(messages)
+            excess = len(self._pending) - self.max_pending
+            for _ in range(max(0, excess)):
+                self._pending.popleft()
+            if excess > 0:
+                self._dropped += excess
+                self.dropped += excess
+            self._changed.notify_all()
+
+    def _print_loop(self):
+        while True:
+            with self._lock:
+                while len(self._pending) == 0 and not self._closed:
+                    self._writing = False
+                    self._changed.notify_all()
+                    self._changed.wait()
+                if len(self._pending) == 0: # Closed
+                    self._writing = False
+                    self._changed.notify_all()
+                    return
+                messages = list(self._pending)
+                self._pending.clear()
+                dropped, self._dropped = self._dropped, 0
+                self._writing = True
+            try:
+                self._write(messages, dropped)
+            except Exception as e:
+                print(">>> There was a problem with printing messages.")
+                print(e)
+
+    def flush(self):
+        """ Wait until the messages given so far are printed. """
+
+        if self._thread is None:
+            return
+        with self._lock:
+            while (len(self._pending) > 0 or self._writing) and self._thread.is_alive():
+                self._changed.wait(1)
+
+    def close(self):
+        """ Print the waiting messages and stop the thread. """
+
+        if self._thread is None:
+            return
+        with self._lock:
+            self._closed = True
+            self._changed.notify_all()
+        self._thread.join()
+
+    def __repr__(self):
+        return "Console renderer ({} printed, {} dropped).".format(self.printed, self.dropped)
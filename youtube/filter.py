@@ -1,39 +1,245 @@
-import dateutil
-from dateutil.parser import parse
-import re
+from dateutil.tz import tzlocal
+import time
+from collections import deque
 
-from .tools import get_channel_title, delete_message
-from learning.question import rnn_predict
+from .usernames import ChannelTitleCache
+from .moderation import Moderator
+
+def _split_sentences(messages, prepare):
+    """ Return the distinct prepared sentences of the messages and, for each
+    sentence, the indices of the messages in which it appears.
+    """
+
+    return prepare([message.content for message in messages], provenance=True)
+
+def _label_questions(messages, sources, predictions, threshold, label):
+    """ Label the messages having a sentence whose probability of being a
+    question is at least threshold, with the probability of the most likely.
+    """
+
+    scores = [0.]*len(messages)
+    for indices, p in zip(sources, predictions):
+        for i in indices:
+            scores[i] = max(scores[i], float(p))
+    for message, score in zip(messages, scores):
+        if score >= threshold:
+            message.add_label(label, score)
+
+class QuestionClassifier:
+    """ A QuestionClassifier is a batch filter (see Session.add_filter) which
+    labels the questions with the RNN model. The messages of a batch are split
+    into sentences, featurized and classified with a single prediction, and
+    a message is labelled if one of its sentences is classified as a question.
+    The label comes with the probability of the most likely question sentence.
+
+    Large batches are split into micro-batches whose size is adapted so that
+    each prediction takes about deadline seconds (as measured on the previous
+    micro-batches).
+
+    The model (and tensorflow) is only imported when a classifier is created.
+    If preload is True, the model is loaded in the background right away,
+    otherwise it is loaded by the first batch.
+
+    Methods:
+        stats: Return statistics about the latency of the batches.
+    """
+
+    batch = True
+
+    def __init__(self, threshold=0.5, label='Q', deadline=0.2, max_batch=512,
+                 preload=True):
+        from learning.question import registry, rnn_predict_sentences, prepare
+        self._predict = rnn_predict_sentences
+        self._prepare = prepare
+        if preload:
+            registry.preload('rnn')
+
+        self.threshold = threshold
+        self.label = label
+        self.deadline = deadline
+        self.max_batch = max_batch
+        self.latencies = deque(maxlen=1000) # (number of messages, seconds)
+        self._seconds_per_message = None
+
+    def _micro_batch_size(self):
+        if self._seconds_per_message is None:
+            return self.max_batch
+        size = int(self.deadline / self._seconds_per_message)
+        return max(1, min(self.max_batch, size))
+
+    def _classify(self, messages):
+        started = time.perf_counter()
+
+        sentences, sources = _split_sentences(messages, self._prepare)
+        if len(sentences) > 0:
+            _label_questions(messages, sources, self._predict(sentences),
+                             self.threshold, self.label)
+
+        latency = time.perf_counter() - started
+        self.latencies.append((len(messages), latency))
+        per_message = latency / len(messages)
+        if self._seconds_per_message is None:
+            self._seconds_per_message = per_message
+        else: # Exponential moving average
+            self._seconds_per_message = 0.8*self._seconds_per_message + 0.2*per_message
+
+    def __call__(self, messages):
+        i = 0
+        while i < len(messages):
+            size = self._micro_batch_size()
+            self._classify(messages[i: i + size])
+            i += size
+
+    def stats(self):
+        """ Return the number of batches, the mean and max latency (seconds)
+        and the throughput (messages per second) of the last 1000 batches.
+        """
+
+        if len(self.latencies) == 0:
+            return {'batches': 0}
+        sizes, seconds = zip(*self.latencies)
+        return {
+            'batches': len(seconds),
+            'mean_latency': sum(seconds) / len(seconds),
+            'max_latency': max(seconds),
+            'messages_per_second': sum(sizes) / sum(seconds) if sum(seconds) > 0 else None,
+        }
+
+    def __repr__(self):
+        return "Question classifier ({}).".format(self.stats())
+
+class RemoteQuestionClassifier:
+    """ A RemoteQuestionClassifier is a batch filter (see Session.add_filter)
+    which labels the questions like a QuestionClassifier, but with the model
+    of an inference server (see learning.question.server), so the chat never
+    waits for tensorflow. If the server doesn't answer within deadline seconds
+    (or fails), the messages of the batch are labelled with the naive "?"
+    heuristic instead.
+
+    The model is any model served by the server: the messages are split into
+    sentences or sent as they are, depending on its predictor_inputs.
+
+    Methods:
+        stats: Return the number of batches and of fallbacks.
+    """
+
+    batch = True
+
+    def __init__(self, client=None, threshold=0.5, label='Q', deadline=0.5,
+                 model='rnn'):
+        from learning.question import prepare, predictor_inputs
+        from learning.question.server import InferenceClient
+        self._prepare = prepare
+        if model not in predictor_inputs:
+            raise ValueError("Unknown model {}.".format(model))
+        self._sentences = predictor_inputs[model] == 'sentences'
+
+        self.client = InferenceClient() if client is None else client
+        self.threshold = threshold
+        self.label = label
+        self.deadline = deadline
+        self.model = model
+        self.batches = self.fallbacks = 0
+
+    def __call__(self, messages):
+        self.batches += 1
+        if self._sentences:
+            inputs, sources = _split_sentences(messages, self._prepare)
+        else:
+            inputs = [message.content for message in messages]
+            sources = [[i] for i in range(len(messages))]
+        if len(inputs) == 0:
+            return
+        try:
+            predictions = self.client.predict(self.model, inputs, timeout=self.deadline)
+        except (TimeoutError, ConnectionError, RuntimeError):
+            self.fallbacks += 1
+            for message in messages:
+                if "?" in message.content:
+                    message.add_label(self.label)
+            return
+        _label_questions(messages, sources, predictions, self.threshold, self.label)
+
+    def stats(self):
+        return {'batches': self.batches, 'fallbacks': self.fallbacks}
+
+    def __repr__(self):
+        return "Remote question classifier ({}).".format(self.stats())
+
+class MaterialQuestionClassifier:
+    """ A MaterialQuestionClassifier is a batch filter (see Session.add_filter)
+    which labels the questions about the material with the DNN model. The
+    messages of a batch are featurized (as a sparse matrix) and classified
+    with a single prediction, and the label comes with the probability.
+
+    The model is only imported when a classifier is created. If preload is
+    True, the model is loaded in the background right away, otherwise it is
+    loaded by the first batch.
+    """
+
+    batch = True
+
+    def __init__(self, threshold=1./25, label='M', preload=True):
+        from learning.question import registry, material_predict
+        self._predict = material_predict
+        if preload:
+            registry.preload('material')
+
+        self.threshold = threshold
+        self.label = label
+
+    def __call__(self, messages):
+        if len(messages) == 0:
+            return
+        predictions = self._predict([message.content for message in messages])
+        for message, p in zip(messages, predictions):
+            if p >= self.threshold:
+                message.add_label(self.label, float(p))
 
 def question_labeler(message):
-    prediction = rnn_predict(message.content)  
+    """ Label message as a question with the RNN model. To label many
+    messages, prefer adding a QuestionClassifier to the session.
+    """
+
+    global _question_classifier
+    if _question_classifier is None:
+        _question_classifier = QuestionClassifier(preload=False)
+    _question_classifier([message])
+
+_question_classifier = None
 
 def naive_question_labeler(message):
     if "?" in message.content:
         message.add_label("Q")
 
-def get_username(client):
-    titles = {}
-    
-    def f(message):
-        if message.author_channel_id in titles:
-            message.author = titles[message.author_channel_id]
-        else:
-            title = get_channel_title(client, message.author_channel_id)
-            titles[message.author_channel_id] = title
-            message.author = title
-    return f
+def get_username(client, **kwargs):
+    """ Return a batch filter setting the author of the messages to the title
+    of their channel. The titles come from a ChannelTitleCache (f.cache),
+    built with the keyword arguments, which requests the unknown titles of a
+    batch together. Add the filter with io=True (see Session.add_filter) so
+    the chat doesn't wait for the requests. client should be an authenticated
+    service of its own, not the one refreshing the chat.
+    """
 
-def delete_pattern(client, pattern):
-    pattern = re.compile(pattern)
-    
-    def f(message):
-        if pattern.search(message.content) is not None:
-            delete_message(client, message.id)
-            
+    cache = ChannelTitleCache(client, **kwargs)
+
+    def f(messages):
+        cache.label(messages)
+    f.batch = True
+    f.cache = cache
     return f
 
+def delete_pattern(client, pattern, **kwargs):
+    """ Return a filter deleting the messages matching pattern (a regex or a
+    list of regexes). See Moderator for the keyword arguments. The messages
+    are deleted by a thread, so client should be an authenticated service of
+    its own, not the one refreshing the chat.
+    """
+
+    if isinstance(pattern, str):
+        pattern = [pattern]
+    return Moderator(client, pattern, **kwargs)
+
     
 def convert_to_local_time(message):
-    dt = parse(message.published_at)
-    message.published_at = str(dt.astimezone(dateutil.tz.tzlocal()))
\ No newline at end of file
+    message.published_dt = message.published_dt.astimezone(tzlocal())
\ No newline at end of file
@@ -0,0 +1,300 @@
+""" metrics module defines counters, gauges and latency histograms to see
+where the time goes between the requests to youtube, the filters of a
+session, the printing and the backups. The metrics are kept in memory (an
+update is a lock and an addition) and their snapshots can be exported to a
+json or a Prometheus text file.
+
+The chats, sessions and writers of the youtube package record their metrics
+in the module's registry (metrics), for example:
+
+    from youtube.metrics import metrics
+    metrics.start_exporting('metrics.prom', interval=10)
+
+The metrics are:
+
+    livechat_requests_total             Requests to youtube
+    livechat_http_errors_total          Requests which failed
+    livechat_request_seconds            Duration of the requests
+    livechat_messages_total             Messages received
+    livechat_build_seconds              Creation of the ChatMessage objects
+    livechat_target_seconds             Putting a batch in the target
+    session_filter_seconds{filter}      Time spent in each filter, per batch
+    session_print_seconds               Printing a batch
+    session_store_seconds               Keeping a batch
+    session_messages_total              Messages kept by the sessions
+    session_pending_batches             Batches waiting for the I/O filters
+    message_lag_seconds                 From publishedAt to being kept
+    writer_write_seconds                Writing a backup batch
+    writer_queue_depth                  Batches waiting to be written
+
+The classes are:
+
+    Counter                 Value which only goes up
+    Gauge                   Value which is set
+    Histogram               Distribution of durations
+    MetricsRegistry         Named metrics and their exports
+"""
+
+import os
+import json
+import time
+import math
+import bisect
+import threading
+import atexit
+
+# Upper bounds (seconds) of the buckets of the histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Counter:
+    """ A Counter is a value which only goes up. """
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Gauge:
+    """ A Gauge is a value which is set (e.g. the size of a queue). """
+
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram:
+    """ A Histogram counts the observed values (durations in seconds) in
+    buckets, and keeps their number, sum and maximum.
+
+    Methods:
+        observe: Record a value.
+        time: Context manager recording the duration of its block.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1) # The last one is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        """ Return the upper bound of the bucket of the q-quantile. """
+
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'mean': self.sum / self.count if self.count > 0 else None,
+                'p50': _bound(self.quantile(0.5)),
+                'p99': _bound(self.quantile(0.99)),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+            }
+
+
+def _bound(value):
+    """ The bound of a bucket, as a json value. """
+
+    return '+Inf' if value == math.inf else value
+
+
+class _Timer:
+    """ Context manager observing the duration of its block in a histogram. """
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    ) + '}'
+
+
+class MetricsRegistry:
+    """ A MetricsRegistry holds named metrics. Getting a metric creates it
+    the first time; a metric may have labels (e.g. the name of a filter),
+    each set of labels being a separate metric.
+
+    Methods:
+        counter: Return a counter.
+        gauge: Return a gauge.
+        histogram: Return a histogram.
+        snapshot: Return the values of all the metrics.
+        write_json: Write a snapshot to a json file.
+        write_prometheus: Write a snapshot in the Prometheus text format.
+        export: Write a snapshot, in a format given by the file extension.
+        start_exporting: Export a snapshot periodically in a thread.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # (name, labels) -> metric
+        self._help = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        try:
+            metric = self._metrics[key]
+        except KeyError:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(**kwargs)
+                    if help is not None:
+                        self._help[name] = help
+        if not isinstance(metric, cls):
+            raise ValueError("The metric {} is a {}.".format(name, metric.kind))
+        return metric
+
+    def counter(self, name, help=None, labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help=None, labels=None):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help=None, labels=None, buckets=BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self):
+        """ Return a dict mapping the names of the metrics (with their labels)
+        to their values.
+        """
+
+        with self._lock:
+            metrics = list(self._metrics.items())
+        snapshot = {'time': time.time()}
+        for (name, labels), metric in sorted(metrics, key=lambda m: m[0]):
+            values = metric.snapshot()
+            values['type'] = metric.kind
+            snapshot[name + _format_labels(dict(labels))] = values
+        return snapshot
+
+    def _prometheus_lines(self):
+        with self._lock:
+            metrics = list(self._metrics.items())
+        lines, described = [], set()
+        for (name, labels), metric in sorted(metrics, key=lambda m: m[0]):
+            labels = dict(labels)
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP {} {}'.format(name, self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+            if metric.kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), metric.value))
+                continue
+            with metric._lock:
+                counts, count, total = list(metric.counts), metric.count, metric.sum
+            cumulative = 0
+            for bound, n in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(dict(labels, le=bound)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return lines
+
+    def _write(self, file_name, text):
+        """ Write text to file_name atomically. """
+
+        tmp_file = file_name + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as f:
+            f.write(text)
+        os.replace(tmp_file, file_name)
+
+    def write_json(self, file_name):
+        self._write(file_name, json.dumps(self.snapshot(), indent=4))
+
+    def write_prometheus(self, file_name):
+        self._write(file_name, '\n'.join(self._prometheus_lines()) + '\n')
+
+    def export(self, file_name):
+        """ Write a snapshot to file_name, in the Prometheus text format if
+        its extension is .prom or .txt, in json otherwise.
+        """
+
+        if os.path.splitext(file_name)[1] in ('.prom', '.txt'):
+            self.write_prometheus(file_name)
+        else:
+            self.write_json(file_name)
+
+    def start_exporting(self, file_name, interval=10):
+        """ Export a snapshot to file_name every interval seconds (and when
+        the program exits) in a daemon thread, and return the thread.
+        """
+
+        def export_loop():
+            while True:
+                time.sleep(interval)
+                self.export(file_name)
+
+        self._exporter = threading.Thread(target=export_loop, daemon=True)
+        self._exporter.start()
+        atexit.register(self.export, file_name)
+        return self._exporter
+
+    def __repr__(self):
+        return "Metrics registry ({} metrics).".format(len(self._metrics))
+
+
+metrics = MetricsRegistry()
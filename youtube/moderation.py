@@ -0,0 +1,278 @@
+""" moderation module defines the Moderator, a filter deleting the chat
+messages matching any of many rules, without making the chat wait for the
+deletions.
+
+The rules are compiled together: the literal rules into a single
+Aho-Corasick automaton and the others into a single regex (an alternation),
+so a message is scanned twice whatever the number of rules. Only the regex
+rules which can't be part of an alternation (with backreferences, named
+groups or inline flags) are searched one by one.
+
+The classes are:
+
+    AhoCorasick             Automaton finding many literals at once
+    RuleSet                 Rules compiled into an automaton and a regex
+    Moderator               Filter deleting the messages matching rules
+"""
+
+import os
+import re
+import time
+import threading
+import atexit
+from collections import deque, Counter
+from configparser import ConfigParser
+
+from apiclient.errors import HttpError
+
+from .tools import delete_message
+
+# Read the config file
+config = ConfigParser()
+config.read(os.path.join(os.getcwd(), 'config.ini'))
+
+MODERATION_RATE = config.getfloat('moderation', 'rate', fallback=2)
+MODERATION_BURST = config.getint('moderation', 'burst', fallback=10)
+
+# A rule without these characters is a literal
+_REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+# Backreferences, named groups, conditionals and inline flags, whose meaning
+# changes in an alternation of groups
+_ISOLATED_RULE = re.compile(r'\\\d|\(\?P|\(\?\(|\(\?[aiLmsux]')
+
+
+class AhoCorasick:
+    """ An AhoCorasick automaton finds all the occurrences of many literals
+    in a text in one pass over the text.
+
+    Methods:
+        search: Return the indices of the literals found in a text.
+    """
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        self._goto = [{}]   # state -> {char: state}
+        self._fail = [0]
+        self._out = [set()] # state -> indices of the literals ending there
+
+        for i, literal in enumerate(self.literals):
+            state = 0
+            for char in literal:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                state = next_state
+            self._out[state].add(i)
+
+        # Breadth first, the fail link of a state is the longest proper suffix
+        # of its prefix which is also a prefix of a literal
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._out[next_state] |= self._out[self._fail[next_state]]
+
+    def search(self, text):
+        """ Return the set of the indices of the literals found in text. """
+
+        found = set()
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class RuleSet:
+    """ A RuleSet compiles rules (regex patterns, as given to re.search) into
+    an AhoCorasick automaton for the literal rules and a single regex for the
+    others, except for the rules using backreferences, named groups or inline
+    flags, which are compiled separately.
+
+    Methods:
+        match: Return the rules matched by a text.
+    """
+
+    def __init__(self, rules, ignore_case=False):
+        self.rules = list(rules)
+        self.ignore_case = ignore_case
+
+        flags = re.IGNORECASE if ignore_case else 0
+        self._literals, self._patterns, self._isolated = [], [], []
+        for rule in self.rules:
+            if _REGEX_CHARS.isdisjoint(rule):
+                self._literals.append(rule)
+                continue
+            regex = re.compile(rule, flags) # Fail now on an invalid rule
+            if _ISOLATED_RULE.search(rule):
+                self._isolated.append((rule, regex))
+            else:
+                self._patterns.append(rule)
+
+        self._automaton = None
+        if self._literals:
+            self._automaton = AhoCorasick(
+                [l.lower() for l in self._literals] if ignore_case else self._literals
+            )
+        self._regex = None
+        if self._patterns:
+            self._regex = re.compile(
+                '|'.join('(?P<r{}>{})'.format(i, p) for i, p in enumerate(self._patterns)),
+                flags
+            )
+
+    def match(self, text):
+        """ Return the list of the rules matched by text. Among regex rules
+        whose matches overlap, only the first (leftmost) one is reported.
+        """
+
+        matched = []
+        if self._automaton is not None:
+            found = self._automaton.search(text.lower() if self.ignore_case else text)
+            matched.extend(self._literals[i] for i in sorted(found))
+        if self._regex is not None:
+            groups = {m.lastgroup for m in self._regex.finditer(text)}
+            matched.extend(self._patterns[int(g[1:])] for g in sorted(groups))
+        matched.extend(rule for rule, regex in self._isolated if regex.search(text))
+        return matched
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class Moderator:
+    """ A Moderator is a filter (see Session.add_filter) deleting the
+    messages matching any of its rules (see RuleSet) and counting the hits of
+    each rule.
+
+    The deletions are queued and made by a background thread, at most rate
+    per second (with bursts of at most burst deletions), so a wave of spam
+    doesn't stall the chat. Since the http object of a youtube service is not
+    thread safe, the client should not be used by another thread at the same
+    time (use a separate authenticated service).
+
+    Methods:
+        flush: Wait until the queued deletions are made.
+        close: Make the queued deletions and stop the thread.
+        stats: Return the hits of each rule and the deletion counts.
+    """
+
+    def __init__(self, client, rules, ignore_case=False, rate=MODERATION_RATE,
+                 burst=MODERATION_BURST):
+        self.client = client
+        self.rules = RuleSet(rules, ignore_case)
+        self.rate = rate
+        self.burst = burst
+
+        self.hits = Counter()
+        self.deleted = self.failed = 0
+        self._queue = deque()
+        self._queued = set() # Ids in the queue
+        self._lock = threading.Lock()
+        self._has_queued = threading.Condition(self._lock)
+        self._busy = False
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._delete_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __call__(self, message):
+        matched = self.rules.match(message.content)
+        if len(matched) == 0:
+            return
+        with self._lock:
+            self.hits.update(matched)
+            if message.id not in self._queued:
+                self._queued.add(message.id)
+                self._queue.append(message.id)
+                self._has_queued.notify_all()
+
+    def _delete_loop(self):
+        tokens, last = self.burst, time.monotonic()
+        while True:
+            with self._lock:
+                while len(self._queue) == 0 and not self._closed:
+                    self._busy = False
+                    self._has_queued.notify_all()
+                    self._has_queued.wait()
+                if len(self._queue) == 0: # Closed
+                    self._busy = False
+                    self._has_queued.notify_all()
+                    return
+                id = self._queue.popleft()
+                self._busy = True
+
+            # Token bucket: wait for a token
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - last)*self.rate)
+            last = now
+            if tokens < 1:
+                time.sleep((1 - tokens)/self.rate)
+                tokens, last = 1, time.monotonic()
+            tokens -= 1
+
+            try:
+                delete_message(self.client, id)
+            except HttpError as e:
+                print("An HTTP error {} occurred while deleting message {}:\n{}"
+                    .format(e.resp.status, id, e.content)
+                )
+                self.failed += 1
+            except Exception as e:
+                print(">>> There was a problem with deleting message {}.".format(id))
+                print(e)
+                self.failed += 1
+            else:
+                self.deleted += 1
+            with self._lock:
+                self._queued.discard(id)
+
+    def flush(self):
+        """ Wait until all the queued deletions are made. """
+
+        with self._lock:
+            while (len(self._queue) > 0 or self._busy) and self._thread.is_alive():
+                self._has_queued.wait(1)
+
+    def close(self):
+        """ Make the queued deletions and stop the thread. """
+
+        with self._lock:
+            self._closed = True
+            self._has_queued.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        """ Return the hits of each rule, the nbr of deletions made, failed
+        and waiting.
+        """
+
+        with self._lock:
+            return {
+                'hits': dict(self.hits),
+                'deleted': self.deleted,
+                'failed': self.failed,
+                'queued': len(self._queue),
+            }
+
+    def __repr__(self):
+        return "Moderator of {} rules ({} deleted, {} queued).".format(
+            len(self.rules), self.deleted, len(self._queue)
+        )
@@ -0,0 +1,113 @@
+""" ressources module defines functions to read files of youtube ressources
+(for example liveChatMessage ressources) without loading them all at once.
+
+Two formats are supported:
+    - a json list of ressources (as written by LiveChat.save_to_json);
+    - one json ressource per line (as the segments of the backup logs).
+
+The functions are:
+
+    iter_ressources         Yield the ressources of a file one at a time
+    load_ressources         Load the list of ressources of a file object
+"""
+
+import json
+import itertools
+
+CHUNK_SIZE = 2**16
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def _iter_json_list(f, text, chunk_size):
+    """ Yield the elements of the json list whose text starts with text (just
+    after the opening bracket) and continues in the file object f.
+    """
+
+    pos = 0
+    expect_comma = False
+    eof = False
+    while True:
+        # Skip the whitespace and the separator before the next element
+        while pos < len(text) and text[pos] in _WHITESPACE:
+            pos += 1
+        if pos < len(text):
+            if text[pos] == ']':
+                return
+            if expect_comma:
+                if text[pos] != ',':
+                    raise ValueError("Expecting ',' delimiter in the ressource file.")
+                pos += 1
+                expect_comma = False
+                continue
+            try:
+                element, end = _decoder.raw_decode(text, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield element
+                pos = end
+                expect_comma = True
+                continue
+        elif eof:
+            raise ValueError("Unterminated json list in the ressource file.")
+
+        # The next element is not complete: read more of the file
+        chunk = f.read(chunk_size)
+        eof = len(chunk) == 0
+        text = text[pos:] + chunk
+        pos = 0
+
+def _iter_json_lines(f, text):
+    """ Yield the json objects of the lines whose text starts with text and
+    continues in the file object f. A torn line at the end of the file (not
+    ending with a new line, e.g. a backup segment still being written) is
+    skipped.
+    """
+
+    lines = [line + '\n' for line in text.split('\n')]
+    # The last line of text may continue in f
+    lines[-1] = lines[-1][:-1] + f.readline()
+    for line in itertools.chain(lines, f):
+        if line.strip():
+            try:
+                element = json.loads(line)
+            except ValueError:
+                if line.endswith('\n'):
+                    raise
+                return
+            yield element
+
+def iter_file_ressources(f, chunk_size=CHUNK_SIZE):
+    """ Yield the ressources in the file object f (a json list or one json
+    ressource per line) one at a time, reading the file by chunks.
+    """
+
+    text = ''
+    while not text:
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0: # Empty file
+            return
+        text = chunk.lstrip()
+
+    if text.startswith('['):
+        yield from _iter_json_list(f, text[1:], chunk_size)
+    else:
+        yield from _iter_json_lines(f, text)
+
+def iter_ressources(file_name, chunk_size=CHUNK_SIZE):
+    """ Yield the ressources saved in file_name one at a time. Only a chunk
+    of the file is held in memory.
+    """
+
+    with open(file_name, 'r', encoding='utf8') as f:
+        yield from iter_file_ressources(f, chunk_size)
+
+def load_ressources(f):
+    """ Load the list of ressources in the file object f, which is either a
+    json list or has one json ressource per line (as the backup segments).
+    """
+
+    return list(iter_file_ressources(f))
@@ -0,0 +1,381 @@
+""" sink module defines the SessionSink class, which streams the messages of a
+session to a file while they arrive, so that a crash loses at most the last
+seconds of the session and saving it doesn't build the whole output in
+memory.
+
+The file is written next to its final name (with a .part extension) and is
+renamed when the sink is finalized. The formats are:
+
+    pretty      The messages as printed, one per line
+    json        A json list of the messages as dictionaries (indent=4)
+    jsonl       One json dictionary per line
+    binary      Length-prefixed records (see pack_message)
+
+If the config file enables it ([session] stream), the scripts stream their
+sessions to the directory [session] streamdir (see open_session_sink), and
+saving a session only renames the file.
+
+The classes are:
+
+    SessionSink             Streams messages to a file
+
+The auxilary functions are:
+
+    open_session_sink       Open the sink of a new session (per the config)
+    format_record           Format a message in a mode
+    pack_string             Encode a string as in a binary record
+    pack_labels             Encode labels as in a binary record
+    pack_record             Encode the fields of a message as a binary record
+    pack_message            Encode a message as a binary record
+    iter_session_file       Read the messages of a json, jsonl or binary file
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import struct
+import datetime
+import threading
+from configparser import ConfigParser
+
+from .chat import ChatMessage
+from .writer import BackgroundWriter
+
+# Read the config file
+config = ConfigParser()
+config.read(os.path.join(os.getcwd(), 'config.ini'))
+
+SESSION_FSYNC_INTERVAL = config.getint('session', 'fsyncinterval', fallback=10)
+SESSION_STREAM = config.getboolean('session', 'stream', fallback=True)
+SESSION_STREAM_DIR = config.get('session', 'streamdir', fallback='sessions')
+SESSION_STREAM_MODE = config.get('session', 'streammode', fallback='jsonl')
+
+MODES = ('pretty', 'json', 'jsonl', 'binary')
+EXTENSIONS = {'pretty': '.txt', 'json': '.json', 'jsonl': '.jsonl', 'binary': '.bin'}
+
+# First bytes of a binary session file
+BINARY_MAGIC = b'BLITZSESSION\x01\n'
+
+_LENGTH = struct.Struct('<I')
+_COUNT = struct.Struct('<H')
+_SCORE = struct.Struct('<d')
+
+
+def pack_string(s):
+    """ Encode a string as in a binary record: its length and utf8 bytes. """
+
+    b = s.encode('utf8')
+    return _LENGTH.pack(len(b)) + b
+
+def pack_labels(labels):
+    """ Encode a list of labels as in a binary record. """
+
+    return _COUNT.pack(len(labels)) + b''.join(pack_string(label) for label in labels)
+
+def pack_record(id, author, author_channel_id, published_at, content, labels,
+                scores):
+    """ Encode the fields of a message as a binary record: its length, then
+    the id, author, author channel id, published_at and content (each a
+    length and utf8 bytes), the labels (a count and strings) and the scores
+    (a count and pairs of a string and a double). The integers are
+    little-endian. Each field may also be given already encoded (bytes, see
+    pack_labels for the labels).
+    """
+
+    parts = [s if isinstance(s, bytes) else pack_string(s) for s in (
+        id, author, author_channel_id, published_at, content
+    )]
+    parts.append(labels if isinstance(labels, bytes) else pack_labels(labels))
+    parts.append(_COUNT.pack(len(scores)))
+    for label, score in scores.items():
+        parts.append(pack_string(label) + _SCORE.pack(score))
+    record = b''.join(parts)
+    return _LENGTH.pack(len(record)) + record
+
+def pack_message(message):
+    """ Encode message as a binary record (see pack_record). """
+
+    return pack_record(
+        message.id, message.author, message.author_channel_id,
+        str(message.published_at), message.content, message.labels,
+        message.scores
+    )
+
+def format_record(message, mode):
+    """ Return the record of message in mode: its text for pretty, its
+    dictionary in json (indented for json, on one line for jsonl) or its
+    binary record. The records are separated by the sink.
+    """
+
+    if mode == 'pretty':
+        return str(message)
+    elif mode == 'json':
+        return json.dumps(message.as_dict(), indent=4, ensure_ascii=False)
+    elif mode == 'jsonl':
+        return json.dumps(message.as_dict(), ensure_ascii=False)
+    else:
+        return pack_message(message)
+
+def _unpack_message(record):
+    offset = 0
+
+    def string():
+        nonlocal offset
+        length, = _LENGTH.unpack_from(record, offset)
+        offset += _LENGTH.size + length
+        return record[offset - length:offset].decode('utf8')
+
+    def count():
+        nonlocal offset
+        n, = _COUNT.unpack_from(record, offset)
+        offset += _COUNT.size
+        return n
+
+    message = ChatMessage({})
+    message.id = string()
+    message.author = string()
+    message.author_channel_id = string()
+    message.published_at = string()
+    message.content = string()
+    message.labels = [string() for _ in range(count())]
+    for _ in range(count()):
+        label = string()
+        message.scores[label], = _SCORE.unpack_from(record, offset)
+        offset += _SCORE.size
+    return message
+
+def _message_from_dict(d):
+    message = ChatMessage({})
+    message.author = d.get('author', '')
+    message.published_at = d.get('published_at', '')
+    message.content = d.get('content', '')
+    message.labels = list(d.get('labels', []))
+    message.scores = dict(d.get('scores', {}))
+    return message
+
+def iter_session_file(file_name, mode=None):
+    """ Iterate over the messages (new ChatMessage objects) of a session file
+    saved in json, jsonl or binary mode (guessed from the first bytes of the
+    file if mode is None). A record torn by a crash at the end of a jsonl or
+    binary file (e.g. a .part file) is skipped.
+    """
+
+    if mode is None:
+        with open(file_name, 'rb') as f:
+            start = f.read(len(BINARY_MAGIC))
+        if start == BINARY_MAGIC:
+            mode = 'binary'
+        else:
+            mode = 'json' if start.lstrip()[:1] == b'[' else 'jsonl'
+
+    if mode == 'binary':
+        with open(file_name, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError("{} is not a binary session file.".format(file_name))
+            while True:
+                header = f.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    return
+                length, = _LENGTH.unpack(header)
+                record = f.read(length)
+                if len(record) < length:
+                    return
+                yield _unpack_message(record)
+    elif mode == 'jsonl':
+        with open(file_name, 'r', encoding='utf8') as f:
+            for line in f:
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    if line.endswith('\n'):
+                        raise
+                    return
+                yield _message_from_dict(d)
+    elif mode == 'json':
+        with open(file_name, 'r', encoding='utf8') as f:
+            for d in json.load(f):
+                yield _message_from_dict(d)
+    else:
+        raise ValueError("Can't read a session saved in mode {}.".format(mode))
+
+
+def open_session_sink(name, mode=SESSION_STREAM_MODE, dir=SESSION_STREAM_DIR):
+    """ Return a SessionSink streaming a session called name (e.g. the title
+    of a broadcast) to a new file of dir, or None if the config file disables
+    the streaming of the sessions.
+    """
+
+    if not SESSION_STREAM:
+        return None
+    os.makedirs(dir, exist_ok=True)
+    file_name = "{}-{:%Y%m%d-%H%M%S}{}".format(
+        re.sub(r'[^\w\-]+', '_', name).strip('_') or 'session',
+        datetime.datetime.now(),
+        EXTENSIONS[mode]
+    )
+    return SessionSink(os.path.join(dir, file_name), mode)
+
+
+class SessionSink:
+    """ A SessionSink streams chat messages to a file, in one of the MODES.
+    The messages are written to part_file (file_name + '.part' by default),
+    by a BackgroundWriter if background is True, fsynced at most every
+    fsync_interval seconds, and the file is renamed to its final name by
+    finalize.
+
+    The output is the same as the one of Session.save in the same mode.
+
+    Attributes:
+        file_name: The final name of the file.
+        mode: The format of the file.
+        count: The nbr of messages written.
+
+    Methods:
+        write: Write a batch of messages.
+        write_records: Write formatted records.
+        flush: Wait until the messages are written, and fsync them.
+        close: Write the end of the file and close it.
+        finalize: Close the file and give it its final name.
+        discard: Close the file and remove it.
+    """
+
+    def __init__(self, file_name, mode='pretty', fsync_interval=SESSION_FSYNC_INTERVAL,
+                 background=True, part_file=None):
+        if mode not in MODES:
+            raise ValueError("Unknown mode: {}".format(mode))
+        self.file_name = file_name
+        self.mode = mode
+        self.fsync_interval = fsync_interval
+        self.count = 0
+
+        self._part_file = file_name + '.part' if part_file is None else part_file
+        if mode == 'binary':
+            self._file = open(self._part_file, 'wb')
+            self._file.write(BINARY_MAGIC)
+        else:
+            self._file = open(self._part_file, 'w', encoding='utf-8')
+            if mode == 'json':
+                self._file.write('[')
+        self._last_fsync = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._writer = None
+        if background:
+            self._writer = BackgroundWriter(self._write, name='session')
+            self._writer.start()
+
+    def _frame(self, record):
+        """ Return the record (see format_record) with its separator. """
+
+        if self.mode == 'pretty':
+            return ('\n' if self.count else '') + record
+        elif self.mode == 'json':
+            return (',\n    ' if self.count else '\n    ') + record.replace('\n', '\n    ')
+        elif self.mode == 'jsonl':
+            return record + '\n'
+        else:
+            return record
+
+    def _write_records(self, records):
+        with self._lock:
+            for record in records:
+                self._file.write(self._frame(record))
+                self.count += 1
+            if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._sync()
+
+    def _write(self, messages):
+        self._write_records(format_record(message, self.mode) for message in messages)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def write(self, messages):
+        """ Write the messages (any iterable if the sink writes from the
+        calling thread, a list otherwise).
+        """
+
+        if self._closed:
+            raise ValueError("The sink is closed.")
+        if self._writer is not None:
+            self._writer.put(messages)
+        else:
+            self._write(messages)
+
+    def write_records(self, records):
+        """ Write records (any iterable) already formatted in the mode of the
+        sink (see format_record), from the calling thread, after the messages
+        given so far.
+        """
+
+        if self._closed:
+            raise ValueError("The sink is closed.")
+        if self._writer is not None:
+            self._writer.flush()
+        self._write_records(records)
+
+    def flush(self):
+        """ Wait until the messages given so far are written, and fsync them. """
+
+        if self._writer is not None:
+            self._writer.flush()
+        with self._lock:
+            if not self._closed:
+                self._sync()
+
+    def close(self):
+        """ Write the queued messages and the end of the file, and close it. """
+
+        if self._closed:
+            return
+        if self._writer is not None:
+            self._writer.close()
+        with self._lock:
+            self._closed = True
+            if self.mode == 'json':
+                self._file.write('\n]' if self.count else ']')
+            self._sync()
+            self._file.close()
+
+    def finalize(self, file_name=None):
+        """ Close the file and rename it to file_name (by default, the name
+        given to the sink). Returns the name of the file.
+        """
+
+        self.close()
+        if file_name is None:
+            file_name = self.file_name
+        if os.path.abspath(file_name) != os.path.abspath(self._part_file):
+            try:
+                os.replace(self._part_file, file_name)
+            except OSError: # Another file system
+                shutil.copyfile(self._part_file, file_name)
+                os.remove(self._part_file)
+        self._part_file = self.file_name = file_name
+        return file_name
+
+    def discard(self):
+        """ Close the file and remove it. """
+
+        self.close()
+        try:
+            os.remove(self._part_file)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __repr__(self):
+        return "Session sink to {} ({} messages, mode {}).".format(
+            self.file_name, self.count, self.mode
+        )
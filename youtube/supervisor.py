@@ -0,0 +1,177 @@
+""" supervisor module defines the ChatSupervisor class, which archives several
+live chats at once in a single process, each chat with its own session,
+buffer and backup directory.
+
+The classes are:
+
+    ChatSupervisor          Runs live chats side by side and watches them
+"""
+
+import time
+import asyncio
+import threading
+
+from .chat import LiveChat, AsyncLiveChat
+from .target import Session
+from .sink import open_session_sink
+
+
+class ChatSupervisor:
+    """ A ChatSupervisor runs live chats side by side: each LiveChat in its
+    own thread, and all the AsyncLiveChat objects in a single event loop (in
+    another thread). The chats don't share any state, but since the http
+    object of a youtube service is not thread safe, each chat should use its
+    own authenticated service.
+
+    Attributes:
+        chats: The supervised chats.
+
+    Methods:
+        add: Supervise a chat.
+        add_chat: Create a chat (and its session) and supervise it.
+        start: Start refreshing the chats.
+        join: Wait until the chats are over.
+        stop: Ask the chats to stop.
+        run: Start the chats and wait until they are over.
+        status: Return the state of each chat.
+    """
+
+    def __init__(self):
+        self.chats = []
+        self._threads = {}  # Chat id -> thread
+        self._lock = threading.Lock()
+
+    def add(self, chat):
+        """ Supervise chat (a LiveChat or an AsyncLiveChat) and return it. """
+
+        with self._lock:
+            if any(c.id == chat.id for c in self.chats):
+                raise ValueError("The chat {} is already supervised.".format(chat.id))
+            self.chats.append(chat)
+        return chat
+
+    def add_chat(self, client, id, target=None, use_asyncio=False, **kwargs):
+        """ Create a chat refreshed with client (an authenticated service
+        used by no other chat), putting its messages in target (by default, a
+        new Session streamed to a file, see open_session_sink), and supervise
+        it. The keyword arguments are given to the chat (e.g. backup_dir).
+        """
+
+        if target is None:
+            target = Session(sink=open_session_sink(id))
+        cls = AsyncLiveChat if use_asyncio else LiveChat
+        return self.add(cls(client, id, target, **kwargs))
+
+    def _finish(self, chat):
+        """ Complete the file to which the session of chat was streamed. """
+
+        target = chat.target
+        if isinstance(target, Session) and target.sink is not None:
+            target.close()
+            target.save()
+
+    def _run_chat(self, chat):
+        try:
+            chat.run()
+        except Exception as e:
+            print(">>> The chat {} stopped on an error.".format(chat.id))
+            print(e)
+            chat.is_over = True
+        self._finish(chat)
+
+    def _run_async_chats(self, chats):
+        # Unlike follow_live_chats, an error in a chat doesn't stop the others
+        async def follow():
+            results = await asyncio.gather(
+                *(chat.run_async() for chat in chats),
+                return_exceptions=True
+            )
+            for chat, result in zip(chats, results):
+                if isinstance(result, Exception):
+                    print(">>> The chat {} stopped on an error.".format(chat.id))
+                    print(result)
+                    chat.is_over = True
+                self._finish(chat)
+        asyncio.run(follow())
+
+    def start(self):
+        """ Start refreshing the chats which aren't running yet. """
+
+        with self._lock:
+            waiting = [c for c in self.chats if c.id not in self._threads]
+            for chat in waiting:
+                if isinstance(chat, AsyncLiveChat):
+                    continue
+                thread = threading.Thread(
+                    target=self._run_chat, args=(chat,),
+                    name="LiveChat {}".format(chat.id), daemon=True
+                )
+                self._threads[chat.id] = thread
+                thread.start()
+
+            async_chats = [c for c in waiting if isinstance(c, AsyncLiveChat)]
+            if len(async_chats) > 0:
+                thread = threading.Thread(
+                    target=self._run_async_chats, args=(async_chats,),
+                    name="AsyncLiveChats", daemon=True
+                )
+                for chat in async_chats:
+                    self._threads[chat.id] = thread
+                thread.start()
+
+    def join(self, timeout=None):
+        """ Wait until the chats are over (or until timeout seconds passed)
+        and return True if they are all over.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in set(self._threads.values()):
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            thread.join(remaining)
+        return not any(thread.is_alive() for thread in self._threads.values())
+
+    def stop(self):
+        """ Ask the chats to stop after their current request. Their buffers
+        are then dumped and their backups written.
+        """
+
+        for chat in self.chats:
+            chat.is_over = True
+
+    def run(self):
+        """ Start the chats and wait until they are over. On a keyboard
+        interrupt, the chats are stopped.
+        """
+
+        self.start()
+        try:
+            while not self.join(timeout=1):
+                pass
+        except KeyboardInterrupt:
+            print(">>> Stopping {} live chats.".format(len(self.chats)))
+            self.stop()
+            self.join()
+
+    def status(self):
+        """ Return a list with, for each chat, its id, whether it is running
+        and over, and the nbr of messages of its target.
+        """
+
+        status = []
+        for chat in self.chats:
+            thread = self._threads.get(chat.id)
+            try:
+                messages = len(chat.target)
+            except TypeError:
+                messages = None
+            status.append({
+                'id': chat.id,
+                'running': thread is not None and thread.is_alive() and not chat.is_over,
+                'over': chat.is_over,
+                'messages': messages,
+            })
+        return status
+
+    def __repr__(self):
+        running = sum(s['running'] for s in self.status())
+        return "Chat supervisor ({} chats, {} running).".format(len(self.chats), running)
@@ -1,86 +1,540 @@
 import json
+import time
+import datetime
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .chat import ChatMessage, epoch_microseconds, from_epoch_microseconds
+from .console import ConsoleRenderer
+from .sink import SessionSink, MODES, format_record, pack_record, pack_labels, pack_string
+from .metrics import metrics
+
+def _filter_name(f):
+    return getattr(f, '__name__', type(f).__name__)
 
 class Session:
     """ A Session is an object which represents a collection of chat messages
     that are processed and saved in a list.
 
+    The filters run in the thread calling extend_messages, up to the first
+    I/O filter (see add_filter). The following filters run on a pool of
+    io_workers threads, so a slow filter doesn't delay the caller, and the
+    batches are printed and kept in the order in which they came.
+
+    The messages are printed by batches with a ConsoleRenderer (by default,
+    one writing in the calling thread). If the session has a sink (see
+    SessionSink), the kept messages are also streamed to its file.
+
     Attributes:
         messages: The list of mesages
+        renderer: The ConsoleRenderer printing the messages
+        sink: The SessionSink writing the messages, or None
 
     Methods:
         extend_messages: Extend the list of messages
+        add_filter: Add a filter
+        flush: Wait until the messages given so far are kept
+        close: Flush and stop the threads of the filters
+        filter_stats: Return the time spent in each filter
         save: Save the session to pretty f json format
     """
 
-    messages = []
-    filters = []
-
-    def __init__(self, print_messages=True):
+    def __init__(self, print_messages=True, io_workers=4, renderer=None, sink=None):
         self.print_messages = print_messages
+        self.io_workers = io_workers
+        self.renderer = ConsoleRenderer() if renderer is None else renderer
+        self.sink = sink
+        self.filters = []
+        self._init_storage()
+
+        self._io_filters = set()  # Ids of the I/O filters
+        self._executor = None
+        self._pending = deque()   # Batches being filtered by the pool, in order
+        self._commit_lock = threading.Lock()
+        self._committed = threading.Condition(self._commit_lock)
+        self._stats = {}          # Id of a filter -> [calls, messages, seconds, max]
+        self._stats_lock = threading.Lock()
+
+        self._print_seconds = metrics.histogram('session_print_seconds', "Printing a batch")
+        self._store_seconds = metrics.histogram('session_store_seconds', "Keeping a batch")
+        self._messages_total = metrics.counter(
+            'session_messages_total', "Messages kept by the sessions")
+        self._pending_batches = metrics.gauge(
+            'session_pending_batches', "Batches waiting for the I/O filters")
+        self._lag_seconds = metrics.histogram(
+            'message_lag_seconds', "From publishedAt to being kept")
+
+    def _apply(self, filters, messages):
+        """ Apply the filters (in order) to the messages, timing them. """
+
+        for filter in filters:
+            started = time.perf_counter()
+            if getattr(filter, 'batch', False):
+                filter(messages)
+            else:
+                for message in messages: filter(message)
+            seconds = time.perf_counter() - started
+            metrics.histogram(
+                'session_filter_seconds', "Time spent in each filter, per batch",
+                {'filter': _filter_name(filter)}
+            ).observe(seconds)
+            with self._stats_lock:
+                stats = self._stats.setdefault(id(filter), [0, 0, 0., 0.])
+                stats[0] += 1
+                stats[1] += len(messages)
+                stats[2] += seconds
+                stats[3] = max(stats[3], seconds)
 
     def extend_messages(self, messages):
-        """ Extend the messages with a list of ChatMessage objects.  """
+        """ Extend the messages with a list of ChatMessage objects. The filters
+        are applied in the order in which they were added. A batch filter (a
+        filter f with f.batch set to True) is called once with the whole list
+        of messages, the other filters are called with each message.
+
+        If there is an I/O filter, the messages are kept once they went
+        through the filters, but this method returns without waiting for the
+        I/O filters (see flush).
+        """
+
+        filtered = list(messages)
+        # Apply the filters up to the first I/O filter
+        split = next(
+            (i for i, f in enumerate(self.filters) if id(f) in self._io_filters),
+            len(self.filters)
+        )
+        self._apply(self.filters[:split], filtered)
+        if split == len(self.filters) and len(self._pending) == 0:
+            self._commit_batch(filtered)
+            return
+
+        # The other filters run in the pool
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.io_workers)
+        with self._commit_lock:
+            future = self._executor.submit(self._apply, self.filters[split:], filtered)
+            self._pending.append((future, filtered))
+            self._pending_batches.set(len(self._pending))
+        future.add_done_callback(lambda future: self._commit())
+
+    def _commit_batch(self, filtered):
+        # Maybe print the filtered messages
+        if self.print_messages:
+            with self._print_seconds.time():
+                self.renderer.render(filtered)
+        with self._store_seconds.time():
+            self._store(filtered)
+        if self.sink is not None:
+            self.sink.write(filtered)
+        self._messages_total.inc(len(filtered))
+
+        now_us = time.time_ns() // 1000
+        for message in filtered:
+            try:
+                self._lag_seconds.observe((now_us - message.published_us) / 1e6)
+            except (AttributeError, TypeError, ValueError): # No (valid) publication time
+                pass
+
+    def _commit(self):
+        """ Keep the batches filtered by the pool, in order: a batch waits
+        until the batches before it are kept.
+        """
+
+        with self._commit_lock:
+            while len(self._pending) > 0 and self._pending[0][0].done():
+                future, filtered = self._pending.popleft()
+                if future.exception() is not None:
+                    print(">>> There was a problem with filtering messages.")
+                    print(future.exception())
+                self._commit_batch(filtered)
+            self._pending_batches.set(len(self._pending))
+            self._committed.notify_all()
+
+    def _init_storage(self):
+        """ Initialize where the messages are kept. """
+
+        self.messages = []
+
+    def _store(self, messages):
+        """ Keep the (filtered) messages. """
+
+        self.messages.extend(messages)
+
+    def add_filter(self, f, io=False):
+        """ Add the filter f, a function called with each message, or with
+        each list of messages if f.batch is True.
+
+        If io is True (for a filter waiting on the network or on the disk),
+        f and the filters added after it run in a pool of threads. They must
+        then be thread safe, since they may filter several batches at once.
+        """
 
-        filtered = []
-        for message in messages:
-            filtered.append(message)
-            # Apply the filters
-            for filter in self.filters: filter(filtered[-1])
-            # Maybe print the filtered message
-            if self.print_messages: print(filtered[-1])
-        self.messages.extend(filtered)
-
-    def add_filter(self, f):
         self.filters.append(f)
+        if io:
+            self._io_filters.add(id(f))
+
+    def flush(self):
+        """ Wait until the messages given so far went through the filters
+        and are kept.
+        """
+
+        with self._commit_lock:
+            while len(self._pending) > 0:
+                self._committed.wait()
+
+    def close(self):
+        """ Flush the messages and stop the threads of the I/O filters and
+        of the renderer. The file of the sink is completed, but keeps its
+        .part name until the session is saved.
+        """
+
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.renderer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    def filter_stats(self):
+        """ Return, for each filter (by name), the nbr of calls and messages,
+        the total and maximal time spent in it (seconds), and whether it is an
+        I/O filter.
+        """
+
+        stats = {}
+        with self._stats_lock:
+            for f in self.filters:
+                calls, messages, seconds, max_seconds = self._stats.get(id(f), [0, 0, 0., 0.])
+                name = _filter_name(f)
+                while name in stats:
+                    name += "'"
+                stats[name] = {
+                    'calls': calls,
+                    'messages': messages,
+                    'seconds': seconds,
+                    'max_seconds': max_seconds,
+                    'io': id(f) in self._io_filters,
+                }
+        return stats
 
-    def save(self, file_name, mode='pretty'):
+    def save(self, file_name=None, mode=None):
         """ Save the list of messages to the file named file_name. If the keyword
         parameter mode equals 'pretty' (default), the session is saved in pretty
         format. If the mode equals 'json', the messages are represented as
-        dictionaries and saved in json format.
-        """
+        dictionaries and saved in json format ('jsonl': one per line). The mode
+        'binary' is a compact format (see youtube.sink).
 
-        if len(self.messages) == 0: print(">>> The session is empty.")
+        If the session has a sink, file_name and mode default to those of the
+        sink. When the sink holds all the messages of the session in the same
+        mode, its file (already written) is completed and renamed to file_name,
+        and the sink is detached. Otherwise the messages are streamed to the
+        file one at a time.
+        """
 
-        if mode == 'pretty':
-            s = '\n'.join([str(mess) for mess in self.messages])
-        elif mode == 'json':
-            s = json.dumps(
-                [mess.as_dict() for mess in self.messages],
-                indent=4,
-                ensure_ascii=False
-            )
-        else:
+        self.flush()
+        if file_name is None:
+            if self.sink is None:
+                print(">>> No file to save the session to.")
+                return
+            file_name = self.sink.file_name
+        if mode is None:
+            mode = 'pretty' if self.sink is None else self.sink.mode
+        if len(self) == 0: print(">>> The session is empty.")
+        if mode not in MODES:
             print(">>> Unknown mode: {}".format(mode))
-        with open(file_name, 'w', encoding='utf-8') as f:
-            try:
-                f.write(s)
-            except Exception as e:
-                print(">>> There was a problem with saving the session.")
-                print(e)
+            return
+
+        try:
+            if self.sink is not None and self.sink.mode == mode:
+                self.sink.flush()
+            if (self.sink is not None and self.sink.mode == mode
+                    and self.sink.count == len(self)):
+                self.sink.finalize(file_name)
+                self.sink = None
             else:
-                print(">>> Session succesfully saved.")
-            
-            
+                # Not the .part file, which may be the one of the sink
+                sink = SessionSink(file_name, mode, background=False,
+                                   part_file=file_name + '.saving')
+                sink.write_records(self._records(mode))
+                sink.finalize()
+                if self.sink is not None and self.sink.file_name == file_name:
+                    # The saved file replaces the one of the sink
+                    self.sink.discard()
+                    self.sink = None
+        except Exception as e:
+            print(">>> There was a problem with saving the session.")
+            print(e)
+        else:
+            print(">>> Session succesfully saved.")
+
+    def _records(self, mode):
+        """ Iterate over the records of the messages in mode (see
+        format_record).
+        """
+
+        for message in self:
+            yield format_record(message, mode)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
 
     def __repr__(self):
         return dict([
-            ("messages", [message.__repr__() for message in self.messages])
+            ("messages", [message.__repr__() for message in self])
         ]).__str__()
 
     def __str__(self):
-        return("Chat object containing {} messages. ".format(len(self.messages)))
+        return("Chat object containing {} messages. ".format(len(self)))
+
+
+# Ways in which a published_at string can be rebuilt from its datetime. The
+# first one is what convert_to_local_time produces, the others are the
+# formats used by youtube.
+_TIME_FORMATS = (
+    str,
+    lambda dt: dt.isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+    lambda dt: dt.isoformat().replace('+00:00', 'Z'),
+)
+_RAW_TIME = -1 # published_at is kept as is
+
+class MessageStore(Session):
+    """ A MessageStore is a Session which stores its messages in columns
+    instead of keeping a ChatMessage object per message:
+        - the authors and author channel ids are interned;
+        - the timestamps are kept in an array of 64 bits integers;
+        - the labels are kept as bitsets (at most 64 different labels).
+
+    Iterating over a MessageStore yields new ChatMessage objects, so
+    modifying them doesn't modify the store. The labels of a message come back
+    in the order in which the store first saw them, without duplicates.
+
+    Attributes:
+        messages: A list of the messages (built on demand)
+
+    Methods:
+        extend_messages: Extend the list of messages
+        save: Save the session to pretty or json format
+    """
+
+    def _init_storage(self):
+        self._strings = []          # Interned authors and channel ids
+        self._string_index = {}
+        self._label_names = []      # Label of bit i
+        self._label_bits = {}
+        self._timezones = {}        # Caches used to rebuild the messages
+        self._bitset_labels = {}
+
+        self._ids = []
+        self._contents = []
+        self._authors = array('l')
+        self._channel_ids = array('l')
+        self._timestamps = array('q') # Microseconds since the epoch
+        self._utcoffsets = array('l') # In seconds
+        self._time_formats = array('b')
+        self._raw_times = {}          # Index -> published_at (str)
+        self._labels = array('Q')
+        self._scores = {}             # Index -> scores (only if not empty)
+
+    @property
+    def messages(self):
+        return list(self)
+
+    def _intern(self, string):
+        try:
+            return self._string_index[string]
+        except KeyError:
+            self._string_index[string] = len(self._strings)
+            self._strings.append(string)
+            return self._string_index[string]
+
+    def _label_bitset(self, labels):
+        bitset = 0
+        for label in labels:
+            try:
+                bit = self._label_bits[label]
+            except KeyError:
+                if len(self._label_names) == 64:
+                    raise ValueError("A MessageStore holds at most 64 labels.")
+                bit = self._label_bits[label] = len(self._label_names)
+                self._label_names.append(label)
+            bitset |= 1 << bit
+        return bitset
+
+    def _time_columns(self, message):
+        """ Return the timestamp, utc offset and time format code of message
+        (the format code is _RAW_TIME if published_at is kept as is).
+        """
+
+        try:
+            dt = message.published_dt
+            offset = dt.utcoffset()
+        except ValueError:
+            offset = None
+        if offset is not None:
+            for code, time_format in enumerate(_TIME_FORMATS):
+                if time_format(dt) == message.published_at:
+                    return (epoch_microseconds(dt),
+                            offset // datetime.timedelta(seconds=1), code)
+        return 0, 0, _RAW_TIME
+
+    def _store(self, messages):
+        for message in messages:
+            # Everything which may fail is computed before the columns are
+            # appended to, so that they stay aligned
+            labels = self._label_bitset(message.labels)
+            timestamp, utcoffset, time_format = self._time_columns(message)
+            author = self._intern(message.author)
+            channel_id = self._intern(message.author_channel_id)
+
+            i = len(self._ids)
+            if time_format == _RAW_TIME:
+                self._raw_times[i] = message.published_at
+            self._timestamps.append(timestamp)
+            self._utcoffsets.append(utcoffset)
+            self._time_formats.append(time_format)
+            self._ids.append(message.id)
+            self._contents.append(message.content)
+            self._authors.append(author)
+            self._channel_ids.append(channel_id)
+            self._labels.append(labels)
+            if message.scores:
+                self._scores[i] = dict(message.scores)
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("MessageStore index out of range")
+
+        message = ChatMessage({})
+        message.id = self._ids[i]
+        message.content = self._contents[i]
+        message.author = self._strings[self._authors[i]]
+        message.author_channel_id = self._strings[self._channel_ids[i]]
+        if self._time_formats[i] == _RAW_TIME:
+            message.published_at = self._raw_times[i]
+        else:
+            dt = from_epoch_microseconds(self._timestamps[i]).astimezone(
+                self._timezone(self._utcoffsets[i])
+            )
+            message.set_published(_TIME_FORMATS[self._time_formats[i]](dt), dt)
+        message.labels = list(self._labels_of(self._labels[i]))
+        message.scores = dict(self._scores.get(i, {}))
+        return message
+
+    def _records(self, mode):
+        """ Iterate over the records of the messages in mode, formatted from
+        the columns: no ChatMessage is built (except for the messages whose
+        published_at is kept as is) and the encoded authors and labels are
+        cached.
+        """
+
+        encoded = {}    # (kind, interned string or bitset) -> encoded
+        def encode(kind, key, value):
+            try:
+                return encoded[kind, key]
+            except KeyError:
+                if kind == 'labels':
+                    value = list(value)
+                    if mode == 'binary':
+                        result = pack_labels(value)
+                    elif mode == 'json':
+                        result = json.dumps(value, indent=4, ensure_ascii=False).replace('\n', '\n    ')
+                    else:
+                        result = json.dumps(value, ensure_ascii=False)
+                elif mode == 'binary':
+                    result = pack_string(value)
+                else:
+                    result = json.dumps(value, ensure_ascii=False)
+                return encoded.setdefault((kind, key), result)
+
+        for i in range(len(self)):
+            code = self._time_formats[i]
+            if code == _RAW_TIME:
+                yield format_record(self[i], mode)
+                continue
+            author = self._strings[self._authors[i]]
+            labels = self._labels_of(self._labels[i])
+            content = self._contents[i]
+
+            if mode == 'pretty':
+                seconds = (self._timestamps[i] // 1000000 + self._utcoffsets[i]) % 86400
+                yield "{} {:20s} at {:02d}:{:02d}:{:02d}: {}".format(
+                    ",".join(labels), author,
+                    seconds // 3600, seconds // 60 % 60, seconds % 60, content
+                )
+                continue
+
+            dt = from_epoch_microseconds(self._timestamps[i]).astimezone(
+                self._timezone(self._utcoffsets[i])
+            )
+            published_at = _TIME_FORMATS[code](dt)
+            scores = self._scores.get(i)
+            if mode == 'binary':
+                yield pack_record(
+                    self._ids[i], encode('author', self._authors[i], author),
+                    encode('author', self._channel_ids[i], self._strings[self._channel_ids[i]]),
+                    published_at, content,
+                    encode('labels', self._labels[i], labels), scores or {}
+                )
+            elif mode == 'jsonl':
+                yield '{{"author": {}, "published_at": {}, "content": {}, "labels": {}{}}}'.format(
+                    encode('author', self._authors[i], author),
+                    json.dumps(published_at), json.dumps(content, ensure_ascii=False),
+                    encode('labels', self._labels[i], labels),
+                    ', "scores": ' + json.dumps(scores, ensure_ascii=False) if scores else ''
+                )
+            else:
+                yield '{{\n    "author": {},\n    "published_at": {},\n    "content": {},\n    "labels": {}{}\n}}'.format(
+                    encode('author', self._authors[i], author),
+                    json.dumps(published_at), json.dumps(content, ensure_ascii=False),
+                    encode('labels', self._labels[i], labels),
+                    ',\n    "scores": ' + json.dumps(scores, indent=4, ensure_ascii=False)
+                        .replace('\n', '\n    ') if scores else ''
+                )
+
+    def _timezone(self, utcoffset):
+        try:
+            return self._timezones[utcoffset]
+        except KeyError:
+            tz = datetime.timezone(datetime.timedelta(seconds=utcoffset))
+            return self._timezones.setdefault(utcoffset, tz)
+
+    def _labels_of(self, bitset):
+        try:
+            return self._bitset_labels[bitset]
+        except KeyError:
+            labels = tuple(
+                label for bit, label in enumerate(self._label_names)
+                if bitset >> bit & 1
+            )
+            return self._bitset_labels.setdefault(bitset, labels)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __str__(self):
+        return("Message store containing {} messages. ".format(len(self)))
 
 
 class Printer:
+    def __init__(self, renderer=None):
+        self.renderer = ConsoleRenderer() if renderer is None else renderer
+
     def extend_messages(self, messages):
-        for message in messages:
-            print(message)
+        self.renderer.render(list(messages))
 
 class MessageList:
-    messages = []
-
     def __init__(self, target=None):
+        self.messages = []
         self.target = target
 
     def extend_messages(self, messages):
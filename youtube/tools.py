@@ -133,5 +133,30 @@ def get_channel_title(client, id):
 
     return response['items'][0]['snippet'].get('title', 'unknown')
 
+def get_channel_titles(client, ids):
+    """ Given an authenticated client and a list of at most 50 channel ids,
+    request the titles of the channels with a single request. Returns a
+    dictionary mapping the ids to the titles ('unknown' when youtube doesn't
+    know the channel) or an empty dictionary if the request failed.
+    """
+
+    request = client.channels().list(
+        id=','.join(ids),
+        part='snippet',
+        maxResults=50
+    )
+    try:
+        response = request.execute()
+    except HttpError as e:
+        print("An HTTP error {} occurred while retrieving channels:\n{}"
+            .format(e.resp.status, e.content)
+        )
+        return {}
+
+    titles = {id: 'unknown' for id in ids}
+    for ress in response.get('items', []):
+        titles[ress['id']] = ress['snippet'].get('title', 'unknown')
+    return titles
+
 def delete_message(client, id):
     request = client.liveChatMessages().delete(id=id).execute()
\ No newline at end of file
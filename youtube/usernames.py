@@ -0,0 +1,182 @@
+""" usernames module defines the ChannelTitleCache class, which finds the
+titles of the channels of the authors of chat messages with as few requests
+to youtube as possible.
+
+The classes are:
+
+    ChannelTitleCache       LRU cache of channel titles, resolved in batches
+"""
+
+import os
+import json
+import time
+import threading
+import atexit
+from collections import OrderedDict
+from configparser import ConfigParser
+
+from .tools import get_channel_titles
+
+# Read the config file
+config = ConfigParser()
+config.read(os.path.join(os.getcwd(), 'config.ini'))
+
+USERNAMES_CACHE_FILE = config.get('usernames', 'cache', fallback=None)
+USERNAMES_CACHE_SIZE = config.getint('usernames', 'size', fallback=10000)
+USERNAMES_TTL = config.getint('usernames', 'ttl', fallback=7*24*3600)
+
+# Maximal number of ids in a channels().list request
+BATCH_SIZE = 50
+
+
+class ChannelTitleCache:
+    """ A ChannelTitleCache object maps channel ids to channel titles. It is
+    a LRU cache of at most maxsize titles, each of which expires after ttl
+    seconds, and it is saved to cache_file between sessions (when closed or
+    when the program exits).
+
+    The titles of a batch of messages are set at once: the ids missing from
+    the cache are requested in batches of up to 50 ids per request, before
+    label returns, so the authors are set before the messages are printed or
+    kept. To keep the chat from waiting for youtube, label the messages in an
+    I/O filter (see Session.add_filter). Since the http object of a youtube
+    service is not thread safe, the requests of the cache are made one at a
+    time, and the client should not be used by another thread at the same
+    time (use a separate authenticated service).
+
+    Methods:
+        label: Set the author of a list of messages.
+        get: Return the cached title of a channel id (or None).
+        save: Save the cache to its file.
+        close: Save the cache.
+    """
+
+    def __init__(self, client, cache_file=USERNAMES_CACHE_FILE,
+                 maxsize=USERNAMES_CACHE_SIZE, ttl=USERNAMES_TTL):
+        self.client = client
+        self.cache_file = cache_file
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._titles = OrderedDict() # id -> (title, time at which it was fetched)
+        self._lock = threading.Lock()
+        self._request_lock = threading.Lock() # One request at a time
+        self._closed = False
+        self.hits = self.misses = self.requests = self.errors = 0
+
+        self._load()
+        atexit.register(self.close)
+
+    def _load(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(">>> There was a problem with loading the channel titles.")
+            print(e)
+            return
+        now = time.time()
+        for id, (title, fetched) in saved.items():
+            if now - fetched < self.ttl:
+                self._store(id, title, fetched)
+
+    def save(self):
+        """ Save the titles which haven't expired to the cache file. """
+
+        if self.cache_file is None:
+            return
+        with self._lock:
+            saved = dict(self._titles)
+        try:
+            with open(self.cache_file, 'w', encoding='utf8') as f:
+                json.dump(saved, f, ensure_ascii=False)
+        except Exception as e:
+            print(">>> There was a problem with saving the channel titles.")
+            print(e)
+
+    def _store(self, id, title, fetched):
+        """ Put a title in the cache, evicting the least recently used. """
+
+        self._titles[id] = (title, fetched)
+        self._titles.move_to_end(id)
+        while len(self._titles) > self.maxsize:
+            self._titles.popitem(last=False)
+
+    def _get(self, id):
+        entry = self._titles.get(id)
+        if entry is None:
+            return None
+        if time.time() - entry[1] >= self.ttl:
+            del self._titles[id]
+            return None
+        self._titles.move_to_end(id)
+        return entry[0]
+
+    def get(self, id):
+        """ Return the cached title of the channel id, or None. """
+
+        with self._lock:
+            return self._get(id)
+
+    def label(self, messages):
+        """ Set the author of each message (a list) to the title of its
+        channel. The titles which aren't cached are requested; if a request
+        fails, the authors of its messages are left as they are.
+        """
+
+        missing = {}    # id -> messages waiting for the title
+        with self._lock:
+            for message in messages:
+                title = self._get(message.author_channel_id)
+                if title is not None:
+                    self.hits += 1
+                    message.author = title
+                else:
+                    self.misses += 1
+                    missing.setdefault(message.author_channel_id, []).append(message)
+
+        ids = list(missing)
+        for i in range(0, len(ids), BATCH_SIZE):
+            titles = self._request(ids[i: i + BATCH_SIZE])
+            now = time.time()
+            with self._lock:
+                for id, title in titles.items():
+                    self._store(id, title, now)
+                    for message in missing.get(id, []):
+                        message.author = title
+
+    def _request(self, ids):
+        """ Return the titles of the channel ids (at most 50), requested with
+        a single request, or an empty dict if the request failed.
+        """
+
+        with self._request_lock:
+            self.requests += 1
+            try:
+                return get_channel_titles(self.client, ids)
+            except Exception as e:
+                print(">>> There was a problem with requesting channel titles.")
+                print(e)
+                self.errors += 1
+                return {}
+
+    def close(self):
+        """ Save the cache. """
+
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.save()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def __repr__(self):
+        return "Channel title cache ({} titles, {} hits, {} misses, {} requests, {} errors).".format(
+            len(self), self.hits, self.misses, self.requests, self.errors
+        )
@@ -0,0 +1,164 @@
+""" writer module defines the BackgroundWriter class, a thread which writes
+batches of data while the thread which produced them keeps working.
+
+The classes are:
+
+    BackgroundWriter(Thread)    Writes the batches put in its bounded queue
+"""
+
+import threading
+import queue
+import atexit
+import time
+
+from .metrics import metrics
+
+
+class BackgroundWriter(threading.Thread):
+    """ A BackgroundWriter is a thread which takes batches (lists) out of a
+    bounded queue and writes them with a write function. When the queue is
+    full, put blocks until the writer catches up (back-pressure) and the time
+    spent waiting is recorded in the statistics.
+
+    The writer is closed when the program exits, so that every batch put in
+    the queue is written (flush-on-exit).
+
+    Attributes:
+        write: Function called with each batch.
+        maxsize: Maximum number of batches waiting in the queue.
+
+    Methods:
+        put: Queue a batch to be written.
+        flush: Wait until all queued batches are written.
+        close: Write the remaining batches and stop the thread.
+        stats: Return a dictionary of statistics about the writer.
+    """
+
+    def __init__(self, write, maxsize=16, name=None):
+        super().__init__(name=name, daemon=True)
+        self.write = write
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self._failed = [] # Batches which couldn't be written (retried)
+        self._closed = False
+        self._stats = {
+            'batches_queued': 0,
+            'batches_written': 0,
+            'items_written': 0,
+            'write_errors': 0,
+            'write_seconds': 0.,
+            'max_queue_depth': 0,
+            'blocked_puts': 0,
+            'blocked_seconds': 0.,
+        }
+        self._stats_lock = threading.Lock()
+        labels = {'writer': name} if name is not None else None
+        self._write_seconds = metrics.histogram(
+            'writer_write_seconds', "Writing a backup batch", labels)
+        self._queue_depth = metrics.gauge(
+            'writer_queue_depth', "Batches waiting to be written", labels)
+        atexit.register(self.close)
+
+    def put(self, batch):
+        """ Queue batch to be written. Blocks while the queue is full. """
+
+        if self._closed:
+            raise ValueError("The writer is closed.")
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            started = time.perf_counter()
+            self._queue.put(batch)
+            with self._stats_lock:
+                self._stats['blocked_puts'] += 1
+                self._stats['blocked_seconds'] += time.perf_counter() - started
+        with self._stats_lock:
+            self._stats['batches_queued'] += 1
+            self._stats['max_queue_depth'] = max(
+                self._stats['max_queue_depth'],
+                self._queue.qsize()
+            )
+        self._queue_depth.set(self._queue.qsize())
+
+    def flush(self):
+        """ Wait until all the batches put so far have been written. """
+
+        if self.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """ Write all the queued batches and stop the thread. Batches which
+        still can't be written are reported.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        else: # Never started: write the queued batches from here
+            while True:
+                try:
+                    batch = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self._handle(batch)
+                finally:
+                    self._queue.task_done()
+            self._failed = [b for b in self._failed if not self._write(b)]
+        if len(self._failed) > 0:
+            print(">>> {} batches could not be written.".format(len(self._failed)))
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            self.write(batch)
+        except Exception as e:
+            print(">>> There was a problem with writing a batch.")
+            print(e)
+            with self._stats_lock:
+                self._stats['write_errors'] += 1
+            return False
+        seconds = time.perf_counter() - started
+        self._write_seconds.observe(seconds)
+        self._queue_depth.set(self._queue.qsize())
+        with self._stats_lock:
+            self._stats['batches_written'] += 1
+            self._stats['items_written'] += len(batch)
+            self._stats['write_seconds'] += seconds
+        return True
+
+    def _handle(self, batch):
+        # Retry the failed batches first to keep the order
+        self._failed = [b for b in self._failed if not self._write(b)]
+        if len(self._failed) > 0 or not self._write(batch):
+            self._failed.append(batch)
+
+    def run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    # Last chance for the batches which failed
+                    self._failed = [b for b in self._failed if not self._write(b)]
+                    return
+                self._handle(batch)
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        """ Return a copy of the statistics of the writer, with the current
+        size of the queue.
+        """
+
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['failed_batches'] = len(self._failed)
+        return stats
+
+    def __repr__(self):
+        return "Background writer ({} batches queued).".format(self._queue.qsize())